@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssm/cache.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the Cache class.
+
+The cache holds downloaded packages so that installing the same
+package more than once (e.g., in several domains) downloads it only
+once. It is enabled by setting $SSM_CACHE_DIR; its size limit, in
+MB, is set by $SSM_CACHE_SIZE (see DEFAULT_CACHE_SIZE).
+
+Entries are named by key: the package md5 when known from the
+repository index (content-addressed), otherwise a digest of the url,
+size and modification time. Entries are added by renaming a
+completed temporary file into place, and least recently used entries
+(by mtime, which is updated on every hit) are evicted under a lock,
+so the cache may be shared by several ssm processes.
+"""
+
+# system imports
+import os
+import os.path
+import time
+
+#
+from ssm.constants import *
+from ssm import utils
+
+# never evict entries used this recently (seconds) as they may be
+# about to be opened by another process
+EVICT_GRACE = 60
+
+def get_cache():
+    """Return Cache object configured from the environment, or None
+    if caching is not enabled.
+    """
+    path = os.environ.get("SSM_CACHE_DIR")
+    if not path:
+        return None
+    try:
+        max_size = int(os.environ.get("SSM_CACHE_SIZE", DEFAULT_CACHE_SIZE))
+    except ValueError:
+        max_size = DEFAULT_CACHE_SIZE
+    return Cache(path, max_size*1024*1024)
+
+def make_key(url, size=None, mtime=None, checksum=None):
+    """Return cache key for package, or None if there is not enough
+    information to identify the package contents.
+    """
+    if checksum:
+        return checksum
+    if size == None or mtime == None:
+        return None
+    m = utils.md5()
+    m.update("%s\n%s\n%s" % (url, size, mtime))
+    return "u%s" % m.hexdigest()
+
+class Cache:
+    """Manager for an on-disk package cache.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = os.path.realpath(path)
+        self.max_size = max_size
+        self.lock_path = os.path.join(self.path, ".lock")
+
+    def _get_entry_path(self, key):
+        return os.path.join(self.path, "%s.ssm" % key)
+
+    def _list_entries(self):
+        """Return list of (mtime, size, path) for all entries.
+        """
+        entries = []
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            names = []
+        for name in names:
+            if name.startswith(".") or not name.endswith(".ssm"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # evicted by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def add(self, key, fileobj, checksum=None, size=None):
+        """Copy package contents from fileobj into the cache, verifying
+        checksum and size (e.g., of a truncated transfer) if given.
+        Return entry path.
+        """
+        if not os.path.isdir(self.path):
+            utils.makedirs(self.path)
+        path = self._get_entry_path(key)
+        tmp_path = os.path.join(self.path, ".tmp.%s.%s" % (key, os.getpid()))
+        m = utils.md5()
+        count = 0
+        try:
+            f = open(tmp_path, "wb")
+            try:
+                while True:
+                    buf = fileobj.read(1024*1024)
+                    if not buf:
+                        break
+                    m.update(buf)
+                    f.write(buf)
+                    count += len(buf)
+            finally:
+                f.close()
+            if size != None and count != size:
+                raise utils.SSMException("error: size mismatch for cached package (%s): got %s of %s bytes" % (key, count, size))
+            if checksum and m.hexdigest() != checksum:
+                raise utils.SSMException("error: checksum mismatch for cached package (%s)" % key)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        utils.print_verbose("added cache entry (%s)" % path)
+        self.prune()
+        return path
+
+    def clear(self):
+        """Remove all entries.
+        """
+        self.prune(0, 0)
+
+    def lookup(self, key):
+        """Return path of entry for key and mark it as recently used,
+        or None if there is no entry.
+        """
+        path = self._get_entry_path(key)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        utils.print_verbose("found cache entry (%s)" % path)
+        return path
+
+    def prune(self, max_size=None, grace=EVICT_GRACE):
+        """Evict least recently used entries until the cache size is
+        no more than max_size (default is the configured size). Return
+        the number of entries evicted.
+
+        Temporary files (see add()) not written to for EVICT_GRACE,
+        left by killed processes, are removed too, whatever grace.
+        """
+        if max_size == None:
+            max_size = self.max_size
+        if not os.path.isdir(self.path):
+            return 0
+
+        count = 0
+        lockf = utils.lock(self.lock_path)
+        try:
+            now = time.time()
+            for name in os.listdir(self.path):
+                if not name.startswith(".tmp."):
+                    continue
+                path = os.path.join(self.path, name)
+                try:
+                    if now-os.path.getmtime(path) >= EVICT_GRACE:
+                        utils.remove(path)
+                except OSError:
+                    # completed or removed by another process
+                    pass
+
+            entries = sorted(self._list_entries())
+            total_size = sum([size for _, size, _ in entries])
+            for mtime, size, path in entries:
+                if total_size <= max_size:
+                    break
+                if now-mtime < grace:
+                    break
+                try:
+                    utils.remove(path)
+                except OSError:
+                    pass
+                total_size -= size
+                count += 1
+        finally:
+            utils.unlock(lockf)
+        return count
+
+    def stats(self):
+        """Return (count, total size, oldest mtime, newest mtime).
+        """
+        entries = self._list_entries()
+        if not entries:
+            return 0, 0, None, None
+        mtimes = [mtime for mtime, _, _ in entries]
+        return len(entries), sum([size for _, size, _ in entries]), min(mtimes), max(mtimes)
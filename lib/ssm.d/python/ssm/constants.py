@@ -35,6 +35,7 @@ VERSION = tuple(VERSION_STRING.split("."))
 PROG_NAME = os.path.basename(sys.argv[0])
 SSM_PKG_DIR = os.path.normpath(os.path.realpath(sys.argv[0])+"/../../../..")
 
+DEFAULT_CACHE_SIZE = 4096 # MB
 DEFAULT_DOMAIN_LABEL = "No label"
 DEFAULT_REPO_SOURCE = "http://ssm/main"
 
@@ -34,6 +34,7 @@ described below.
       login
       platforms/
       profile
+      publish-records/
       published/
       sources.list
       subdomains
@@ -61,6 +62,23 @@ The contents under etc/ssm.d/:
 2) provide the basic login and profile scripts used for shell
 configuration.
 
+publish-records/<platform>/<package_name> lists what publishing the
+package to the platform directory created, so that unpublishing
+removes exactly that (see format_publish_record()). Packages
+published before records were kept are unpublished by walking the
+platform directory.
+
+publish-index/<platform> maps each link published to the platform
+directory to the package owning it (see format_publish_index()).
+It is updated, under lock, by each publish and unpublish, and
+rebuilt from the publish records (or the links themselves) when
+missing.
+
+A publish transaction (see start_publish()) publishes and unpublishes
+packages in a shadow copy (.<platform>.publishing) of the platform
+directory, which then replaces the platform directory in a single
+rename, so the packages appear (or disappear) all at once.
+
 The contents under lib/ssm.d/ are helpers for setting up the shell
 environment for a whole domain (and subdomains) or a single package
 within a domain.
@@ -74,7 +92,9 @@ Packages "living" in a domain must have been properly installed and
 and said to be "installed". Some packages may also be published,
 which is simply having its PUBLISHABLE_NAMES symlinked to a
 platform directory of a domain. All packages published to such a
-directory share it; namespace collisions are not handled by SSM.
+directory share it; publishing a package which would replace files
+already there (e.g., published by another package) fails before
+anything is published, unless forced.
 
 A domain supports an ordered list of platforms (determined by the
 ssm_platforms.sh helper). Shell environment configuration is done
@@ -111,6 +131,69 @@ PUBLISHABLE_NAMES = [
     "share",
 ]
 
+PUBLISH_RECORD_VERSION = 1
+PUBLISH_RECORD_HEADER = "# ssm publish record version %s" % PUBLISH_RECORD_VERSION
+
+def format_publish_record(entries):
+    """Return publish record contents for list of (type, rel_path,
+    linkname) entries: type is "l" for a symlink (to linkname) or
+    "d" for a directory (no linkname); rel_path is relative to the
+    platform directory. Paths are escaped as in package manifests.
+    """
+    lines = [PUBLISH_RECORD_HEADER]
+    for type, rel_path, linkname in entries:
+        lines.append("%s\t%s\t%s" % (type, rel_path.encode("string_escape"),
+            linkname.encode("string_escape")))
+    return "\n".join(lines)+"\n"
+
+def parse_publish_record(s):
+    """Return list of (type, rel_path, linkname) entries from
+    publish record contents, or None if the contents are not a
+    supported record.
+    """
+    lines = s.split("\n")
+    if lines[0].strip() != PUBLISH_RECORD_HEADER:
+        return None
+    entries = []
+    for line in lines[1:]:
+        if line.startswith("#") or line.strip() == "":
+            continue
+        t = line.split("\t")
+        if len(t) < 3:
+            return None
+        entries.append((t[0], t[1].decode("string_escape"), t[2].decode("string_escape")))
+    return entries
+
+PUBLISH_INDEX_VERSION = 1
+PUBLISH_INDEX_HEADER = "# ssm publish index version %s" % PUBLISH_INDEX_VERSION
+
+def format_publish_index(index):
+    """Return publish index contents for map of rel_path to
+    package_name, one tab-separated entry per line, sorted by
+    rel_path (escaped as in publish records).
+    """
+    lines = [PUBLISH_INDEX_HEADER]
+    for rel_path in sorted(index):
+        lines.append("%s\t%s" % (rel_path.encode("string_escape"), index[rel_path]))
+    return "\n".join(lines)+"\n"
+
+def parse_publish_index(s):
+    """Return map of rel_path to package_name from publish index
+    contents, or None if the contents are not a supported index.
+    """
+    lines = s.split("\n")
+    if lines[0].strip() != PUBLISH_INDEX_HEADER:
+        return None
+    index = {}
+    for line in lines[1:]:
+        if line.startswith("#") or line.strip() == "":
+            continue
+        t = line.split("\t")
+        if len(t) < 2:
+            return None
+        index[t[0].decode("string_escape")] = t[1]
+    return index
+
 SSM_LOGIN_TEMPLATE = """
 # login
 #
@@ -153,11 +236,18 @@ class Domain:
         self.login_path = "%s/etc/ssm.d/login" % self.path
         self.platforms_path = "%s/etc/ssm.d/platforms" % self.path
         self.profile_path = "%s/etc/ssm.d/profile" % self.path
+        self.publish_index_path = "%s/etc/ssm.d/publish-index" % self.path
+        self.publish_records_path = "%s/etc/ssm.d/publish-records" % self.path
         self.published_path = "%s/etc/ssm.d/published" % self.path
         self.sources_path = "%s/etc/ssm.d/sources.list" % self.path
         self.subdomains_path = "%s/etc/ssm.d/subdomains" % self.path
         self.version_path = "%s/etc/ssm.d/version" % self.path
 
+        # publish index locks held and publish transactions, by
+        # platform
+        self.publish_locks = {}
+        self.transactions = {}
+
     # state
     def _get_state_link_dir(self, state_path, platform=None):
         if platform == None or self.get_version() < (10, 0):
@@ -208,6 +298,9 @@ class Domain:
         self._add_state(self.installed_path, path)
 
     def add_published(self, path, platform=None):
+        if platform in self.transactions:
+            self.transactions[platform]["deferred"].append((self.add_published, (path, platform)))
+            return
         self._add_state(self.published_path, path, platform)
 
     def get_excluded_names(self):
@@ -291,6 +384,86 @@ class Domain:
                 del domain
         return m
 
+    def _build_publish_index(self, platform):
+        """Return publish index for platform from the publish records
+        of the packages published to it. Links of packages without a
+        record are attributed by their target.
+        """
+        pub_dir = os.path.join(self.path, platform)
+        index = {}
+        unrecorded = {}
+        for link_path in self.get_published(platform):
+            pkg_path = os.path.realpath(link_path)
+            package_name = os.path.basename(pkg_path)
+            record = self.get_publish_record(package_name, platform)
+            if record == None:
+                unrecorded[pkg_path] = package_name
+                continue
+            for type, rel_path, linkname in record:
+                try:
+                    if type == "l" and os.readlink(os.path.join(pub_dir, rel_path)) == linkname:
+                        index[rel_path] = package_name
+                except OSError:
+                    pass
+
+        if unrecorded:
+            pub_dir_len = len(pub_dir)
+            for root, dirnames, filenames in os.walk(pub_dir):
+                for name in dirnames+filenames:
+                    pub_path = os.path.join(root, name)
+                    rel_path = pub_path[pub_dir_len+1:]
+                    if rel_path in index or not os.path.islink(pub_path):
+                        continue
+                    path = os.path.normpath(os.path.join(root, os.readlink(pub_path)))
+                    while path not in unrecorded and path != "/":
+                        path = os.path.dirname(path)
+                    if path in unrecorded:
+                        index[rel_path] = unrecorded[path]
+        return index
+
+    def _get_publish_index_path(self, platform):
+        return os.path.join(self.publish_index_path, platform)
+
+    def _get_publish_record_path(self, package_name, platform):
+        return os.path.join(self.publish_records_path, platform, package_name)
+
+    def get_publish_record(self, package_name, platform):
+        """Return list of entries (see parse_publish_record()) created
+        by publishing package to platform, or None if not recorded.
+        """
+        records = platform in self.transactions and self.transactions[platform]["records"] or {}
+        if package_name in records:
+            return records[package_name]
+        path = self._get_publish_record_path(package_name, platform)
+        if not os.path.exists(path):
+            return None
+        return parse_publish_record(utils.loads(path))
+
+    def get_publish_index(self, platform):
+        """Return map of rel_path to package_name for the links
+        published to platform (see format_publish_index()).
+        """
+        if platform in self.transactions:
+            return self.transactions[platform]["index"]
+        lock = self.publish_locks.get(platform)
+        if lock and lock["index"] != None:
+            return lock["index"]
+        path = self._get_publish_index_path(platform)
+        index = None
+        if os.path.exists(path):
+            index = parse_publish_index(utils.loads(path))
+        if index == None:
+            index = self._build_publish_index(platform)
+        if lock:
+            lock["index"] = index
+        return index
+
+    def get_publish_owner(self, rel_path, platform):
+        """Return name of package owning the link rel_path (relative
+        to the platform directory), or None.
+        """
+        return self.get_publish_index(platform).get(os.path.normpath(rel_path))
+
     def get_published(self, platform=None):
         if self.get_version() >= (10, 0):
             platforms = platform and [platform] or self.get_published_platforms()
@@ -396,9 +569,44 @@ class Domain:
     def remove_installed(self, path):
         self._remove_state(self.installed_path, path)
 
+    def remove_publish_record(self, package_name, platform):
+        if platform in self.transactions:
+            self.transactions[platform]["records"][package_name] = None
+            return
+        path = self._get_publish_record_path(package_name, platform)
+        if os.path.lexists(path):
+            utils.remove(path)
+
     def remove_published(self, path, platform=None):
+        if platform in self.transactions:
+            self.transactions[platform]["deferred"].append((self.remove_published, (path, platform)))
+            return
         self._remove_state(self.published_path, path, platform)
 
+    def set_publish_index(self, platform, index):
+        if platform in self.transactions:
+            self.transactions[platform]["index"] = index
+            return
+        lock = self.publish_locks.get(platform)
+        if lock:
+            # written by _unlock_publish_index()
+            lock["index"] = index
+            lock["dirty"] = True
+            return
+        path = self._get_publish_index_path(platform)
+        if not os.path.isdir(os.path.dirname(path)):
+            utils.makedirs(os.path.dirname(path))
+        utils.dumps_atomic(format_publish_index(index), path)
+
+    def set_publish_record(self, package_name, platform, entries):
+        if platform in self.transactions:
+            self.transactions[platform]["records"][package_name] = entries
+            return
+        path = self._get_publish_record_path(package_name, platform)
+        if not os.path.isdir(os.path.dirname(path)):
+            utils.makedirs(os.path.dirname(path))
+        utils.dumps_atomic(format_publish_record(entries), path)
+
     def set_label(self, s):
         utils.dumps(s, self.label_path)
 
@@ -412,6 +620,65 @@ class Domain:
         utils.dumps(s, self.version_path)
 
     # operations
+    def abort_publish(self, platform):
+        """Abort the publish transaction on platform: the platform
+        directory, publish records, index and states are left as they
+        were. The shadow directory is removed, not kept for reuse.
+        """
+        transaction = self.transactions.pop(platform)
+        try:
+            utils.rmtree(transaction["shadow_dir"])
+        finally:
+            self._unlock_publish_index(platform)
+
+    def commit_publish(self, platform):
+        """Replace the platform directory by the shadow directory of
+        the publish transaction on platform, then update the publish
+        records, index and states. The directories are exchanged
+        atomically where supported; otherwise the platform directory
+        is briefly missing, never partially published.
+
+        The replaced platform directory is kept as the shadow
+        directory, with the paths the transaction changed, for the
+        next start_publish() to bring up to date.
+        """
+        transaction = self.transactions.pop(platform)
+        try:
+            pub_dir = os.path.join(self.path, platform)
+            shadow_dir = transaction["shadow_dir"]
+            rel_paths = None
+            if not transaction["untracked"]:
+                rel_paths = self._get_transaction_paths(platform, transaction)
+            if not os.path.isdir(pub_dir):
+                utils.rename(shadow_dir, pub_dir)
+                old_dir = None
+            elif utils.exchange(shadow_dir, pub_dir):
+                old_dir = shadow_dir
+            else:
+                old_dir = shadow_dir+".old"
+                utils.rename(pub_dir, old_dir)
+                utils.rename(shadow_dir, pub_dir)
+
+            for package_name, entries in transaction["records"].items():
+                if entries == None:
+                    self.remove_publish_record(package_name, platform)
+                else:
+                    self.set_publish_record(package_name, platform, entries)
+            self.set_publish_index(platform, transaction["index"])
+            for func, args in transaction["deferred"]:
+                func(*args)
+
+            if old_dir and rel_paths != None:
+                if old_dir != shadow_dir:
+                    utils.rename(old_dir, shadow_dir)
+                lines = [utils.md5(format_publish_index(transaction["index"])).hexdigest()]
+                lines.extend([rel_path.encode("string_escape") for rel_path in sorted(rel_paths)])
+                utils.dumps("\n".join(lines)+"\n", self._get_publish_shadow_path(platform))
+            elif old_dir:
+                utils.rmtree(old_dir)
+        finally:
+            self._unlock_publish_index(platform)
+
     def create(self, label, repo_source):
         """Create domain home.
         """
@@ -448,61 +715,527 @@ class Domain:
         """
         utils.touch(self.frozen_path)
 
-    def publish_package(self, package, platform=None):
-        """Publish package to domain.
+    def _get_publish_plan(self, package):
+        """Return list of (type, rel_path, path) for publishing
+        package: type is "d" for a directory to create (if
+        missing) or "l" for a link to path.
+        """
+        pkg_path_len = len(package.path)+1
+        plan = []
+        for path in package.get_publishable_paths(PUBLISHABLE_NAMES):
+            rel_path = path[pkg_path_len:]
+            linkname = os.path.islink(path) and os.readlink(path)
+
+            if rel_path in PUBLISHABLE_NAMES:
+                # enforce directory creation for publishable
+                # names even if the package uses a symlink
+                plan.append(("d", rel_path, path))
+            elif os.path.isdir(path) \
+                and (linkname == False or linkname[:2]+linkname[-2:] == ".//."):
+                plan.append(("d", rel_path, path))
+            elif os.path.isfile(path) or os.path.islink(path):
+                plan.append(("l", rel_path, path))
+        return plan
+
+    def _check_publish_conflicts(self, pub_dir, index, plan, owners=None):
+        """Check that the links of plan (see _get_publish_plan())
+        would not replace files in pub_dir, other than links of
+        owners. Conflicts are reported, and raise an exception unless
+        forced.
+        """
+        owners = owners or []
+        conflicts = []
+        for type, rel_path, path in plan:
+            if type == "l":
+                owner = index.get(rel_path)
+                if owner in owners:
+                    continue
+                if owner != None or os.path.lexists(os.path.join(pub_dir, rel_path)):
+                    conflicts.append((rel_path, owner or "unknown"))
+        for rel_path, owner in conflicts:
+            if globls.force:
+                utils.print_warning("warning: replacing (%s) published by package (%s)" % (rel_path, owner))
+            else:
+                utils.print_error("error: (%s) already published by package (%s)" % (rel_path, owner))
+        if conflicts and not globls.force:
+            raise utils.SSMExitException("error: publishing would replace %s file(s)" % len(conflicts))
+
+    def _get_publish_dir(self, platform):
+        """Return the directory to publish to for platform: the
+        shadow directory during a transaction.
+        """
+        if platform in self.transactions:
+            return self.transactions[platform]["shadow_dir"]
+        return os.path.join(self.path, platform)
+
+    def _get_publish_shadow_path(self, platform):
+        """Return path of the file listing the paths changed by the
+        last publish transaction on platform (see commit_publish()).
+        """
+        return self._get_publish_index_path(platform)+".shadow"
+
+    def _forget_publish_shadow(self, platform):
+        """Make the next publish transaction on platform clone the
+        platform directory anew: it is being changed outside of a
+        transaction.
+        """
+        if platform not in self.transactions:
+            path = self._get_publish_shadow_path(platform)
+            if os.path.lexists(path):
+                utils.remove(path)
+
+    def _get_transaction_paths(self, platform, transaction):
+        """Return the set of paths (relative to the platform
+        directory), with their parents, changed by the publish
+        transaction on platform: those of the old and new publish
+        records it replaces.
+        """
+        rel_paths = set()
+        for package_name, entries in transaction["records"].items():
+            path = self._get_publish_record_path(package_name, platform)
+            old_entries = os.path.exists(path) and parse_publish_record(utils.loads(path)) or []
+            for type, rel_path, linkname in old_entries+(entries or []):
+                while rel_path and rel_path not in rel_paths:
+                    rel_paths.add(rel_path)
+                    rel_path = os.path.dirname(rel_path)
+        return rel_paths
+
+    def _sync_publish_shadow(self, platform, pub_dir, shadow_dir, index):
+        """Bring shadow_dir, kept by the last publish transaction on
+        platform, up to date with pub_dir by redoing only the paths
+        that transaction changed. Return False if it cannot be: not
+        kept, or pub_dir changed otherwise since.
+        """
+        path = self._get_publish_shadow_path(platform)
+        if not os.path.exists(path) or not os.path.isdir(shadow_dir) \
+                or os.path.islink(shadow_dir):
+            return False
+        lines = utils.loads(path).split("\n")
+        utils.remove(path)
+        if lines[0] != utils.md5(format_publish_index(index)).hexdigest():
+            return False
+        rel_paths = [line.decode("string_escape") for line in lines[1:] if line]
+
+        utils.print_verbose("updating shadow directory (%s)" % shadow_dir)
+        # parents first
+        for rel_path in sorted(rel_paths):
+            pub_path = os.path.join(pub_dir, rel_path)
+            shadow_path = os.path.join(shadow_dir, rel_path)
+            if os.path.islink(pub_path):
+                linkname = os.readlink(pub_path)
+                if os.path.islink(shadow_path):
+                    if os.readlink(shadow_path) == linkname:
+                        continue
+                    utils.remove(shadow_path)
+                elif os.path.isdir(shadow_path):
+                    return False
+                elif os.path.lexists(shadow_path):
+                    utils.remove(shadow_path)
+                utils.symlink(linkname, shadow_path)
+            elif os.path.isdir(pub_path):
+                if os.path.islink(shadow_path) or os.path.isfile(shadow_path):
+                    utils.remove(shadow_path)
+                if not os.path.isdir(shadow_path):
+                    utils.makedirs(shadow_path)
+            elif os.path.lexists(pub_path):
+                # not published by ssm
+                if not os.path.lexists(shadow_path) \
+                        or not os.path.samefile(pub_path, shadow_path):
+                    return False
+            elif os.path.islink(shadow_path) or os.path.isfile(shadow_path):
+                utils.remove(shadow_path)
+        # directories no longer published, deepest first
+        for rel_path in sorted(rel_paths, reverse=True):
+            shadow_path = os.path.join(shadow_dir, rel_path)
+            if not os.path.lexists(os.path.join(pub_dir, rel_path)) \
+                    and os.path.isdir(shadow_path) and not os.path.islink(shadow_path):
+                if os.listdir(shadow_path):
+                    return False
+                utils.rmdir(shadow_path)
+        return True
+
+    def _check_transaction_scripts(self, platform, package, steps):
+        """Refuse package, with a script for any of steps, during a
+        publish transaction on platform: scripts are given the domain
+        path, so would change the platform directory rather than the
+        shadow one (and their changes be lost on commit).
+        """
+        if platform not in self.transactions:
+            return
+        for step in steps:
+            if os.path.isfile(os.path.join(package.path, ".ssm.d", step)):
+                raise utils.SSMExitException("error: cannot publish atomically package with %s script (%s)" % (step, package.name))
+
+    def _lock_publish_index(self, platform):
+        """Lock the publish index of platform. Calls nest: until the
+        matching (last) _unlock_publish_index(), the index is read
+        once and changes to it are kept in memory.
+        """
+        lock = self.publish_locks.get(platform)
+        if lock:
+            lock["count"] += 1
+            return
+        if not os.path.isdir(self.publish_index_path):
+            utils.makedirs(self.publish_index_path)
+        lockf = utils.lock(self._get_publish_index_path(platform)+".lock")
+        self.publish_locks[platform] = {
+            "count": 1,
+            "dirty": False,
+            "index": None,
+            "lockf": lockf,
+        }
+
+    def _unlock_publish_index(self, platform):
+        """Release lock acquired by _lock_publish_index(); the last
+        one writes the index, if changed.
+        """
+        lock = self.publish_locks[platform]
+        lock["count"] -= 1
+        if lock["count"]:
+            return
+        del self.publish_locks[platform]
+        try:
+            if lock["dirty"]:
+                self.set_publish_index(platform, lock["index"])
+        finally:
+            utils.unlock(lock["lockf"])
+
+    def publish_package(self, package, platform=None, plan=None):
+        """Publish package to domain. The links and directories
+        created are recorded (see get_publish_record()), also on
+        failure, for unpublish_package(). plan is that of
+        _get_publish_plan(), if already known.
+
+        All links are checked against the publish index (and the
+        platform directory) first: if any would replace an existing
+        file, nothing is published, unless forced.
+        """
+        if self.is_frozen():
+            raise utils.SSMExitException("error: domain is frozen")
+        if package.domain.is_broken(package.name) and not globls.force:
+            raise utils.SSMExitException("error: package is broken")
+
+        if platform == None:
+            platform = package.platform
+        self._check_transaction_scripts(platform, package, ["pre-publish", "post-publish"])
+        pub_dir = self._get_publish_dir(platform)
+        self._lock_publish_index(platform)
+        try:
+            self._forget_publish_shadow(platform)
+            index = self.get_publish_index(platform)
+            if plan == None:
+                plan = self._get_publish_plan(package)
+            self._check_publish_conflicts(pub_dir, index, plan)
+
+            try:
+                if not os.path.exists(pub_dir):
+                    utils.makedirs(pub_dir)
+
+                package.execute_script("pre-publish", self)
+
+                created = []
+                try:
+                    for type, rel_path, path in plan:
+                        pub_path = os.path.join(pub_dir, rel_path)
+                        if type == "d":
+                            if not os.path.exists(pub_path):
+                                utils.makedirs(pub_path)
+                                created.append(("d", rel_path, ""))
+                        else:
+                            if globls.force:
+                                utils.remove(pub_path)
+                            utils.symlink(path, pub_path)
+                            created.append(("l", rel_path, path))
+                            index[rel_path] = package.name
+                finally:
+                    self.set_publish_record(package.name, platform, created)
+                    self.set_publish_index(platform, index)
+
+                package.execute_script("post-publish", self)
+
+                self.add_published(package.path, platform)
+                self.remove_broken(package.path)
+            except:
+                if globls.debug:
+                    traceback.print_exc()
+                self.add_broken(package.path)
+                raise utils.SSMExitException("error: could not publish")
+        finally:
+            self._unlock_publish_index(platform)
+
+    def publish_packages(self, items, platform):
+        """Publish the packages of (package, old_packages) items to
+        platform, replacing their old_packages (see
+        republish_package()), under a single lock of the publish
+        index. The links of all packages are checked, against each
+        other and the platform directory, before any is published; in
+        order, so that a package may take over the links of those
+        replaced before it.
+        """
+        self._lock_publish_index(platform)
+        try:
+            pub_dir = self._get_publish_dir(platform)
+            index = self.get_publish_index(platform)
+            owners = {}
+            plans = []
+            conflicts = []
+            for package, old_packages in items:
+                plan = self._get_publish_plan(package)
+                plans.append(plan)
+                for type, rel_path, path in plan:
+                    if type == "l":
+                        if rel_path in owners:
+                            conflicts.append((rel_path, owners[rel_path], package.name))
+                        else:
+                            owners[rel_path] = package.name
+            for rel_path, owner, package_name in conflicts:
+                if globls.force:
+                    utils.print_warning("warning: (%s) of package (%s) replaced by package (%s)" % (rel_path, owner, package_name))
+                else:
+                    utils.print_error("error: (%s) provided by packages (%s) and (%s)" % (rel_path, owner, package_name))
+            if conflicts and not globls.force:
+                raise utils.SSMExitException("error: packages would replace %s file(s) of each other" % len(conflicts))
+            if not globls.force:
+                # forced replacements are reported when publishing;
+                # checked in order, against the index as the packages
+                # before leave it: links of the packages they replaced
+                # are gone
+                index = dict(index)
+                old_names = []
+                for (package, old_packages), plan in zip(items, plans):
+                    old_names.extend([old_package.name for old_package in old_packages])
+                    self._check_publish_conflicts(pub_dir, index, plan, old_names)
+                    for type, rel_path, path in plan:
+                        if type == "l":
+                            index[rel_path] = package.name
+
+            for (package, old_packages), plan in zip(items, plans):
+                utils.print_verbose("publishing package (%s)" % package.name)
+                if old_packages:
+                    self.republish_package(package, old_packages, platform, plan)
+                else:
+                    self.publish_package(package, platform, plan)
+        finally:
+            self._unlock_publish_index(platform)
+
+    def republish_package(self, package, old_packages, platform=None, plan=None):
+        """Publish package in place of old_packages (published to
+        platform; e.g., package itself or other versions of it),
+        changing only what differs: links to the same target are
+        kept, links to a new target are replaced in place (by
+        rename), and only the links and directories no longer
+        published are removed. The pre-/post-unpublish scripts of
+        old_packages run before/after those of package.
+
+        Falls back to unpublish_package() and publish_package() if an
+        old package has no publish record. plan is as for
+        publish_package().
         """
         if self.is_frozen():
             raise utils.SSMExitException("error: domain is frozen")
         if package.domain.is_broken(package.name) and not globls.force:
             raise utils.SSMExitException("error: package is broken")
 
+        if platform == None:
+            platform = package.platform
+        self._check_transaction_scripts(platform, package, ["pre-publish", "post-publish"])
+        for old_package in old_packages:
+            self._check_transaction_scripts(platform, old_package, ["pre-unpublish", "post-unpublish"])
+        records = {}
+        for old_package in old_packages:
+            records[old_package.name] = self.get_publish_record(old_package.name, platform)
+        if None in records.values():
+            utils.print_verbose("no publish record, unpublishing fully")
+            for old_package in old_packages:
+                self.unpublish_package(old_package, platform)
+            self.publish_package(package, platform, plan)
+            return
+
+        pub_dir = self._get_publish_dir(platform)
+        self._lock_publish_index(platform)
         try:
-            if platform == None:
-                platform = package.platform
-            pkg_path_len = len(package.path)+1
-            pub_dir = os.path.join(self.path, platform)
-            if not os.path.exists(pub_dir):
-                utils.makedirs(pub_dir)
-
-            package.execute_script("pre-publish", self)
-
-            for path in package.get_publishable_paths(PUBLISHABLE_NAMES):
-                rel_path = path[pkg_path_len:]
-                pub_path = os.path.join(pub_dir, rel_path)
-                real_path = os.path.realpath(path)
-                linkname = os.path.islink(path) and os.readlink(path)
-
-                if rel_path in PUBLISHABLE_NAMES:
-                    # enforce directory creation for publishable
-                    # names even if the package uses a symlink
-                    if not os.path.exists(pub_path):
-                        utils.makedirs(pub_path)
-                elif os.path.isdir(path) \
-                    and (linkname == False or linkname[:2]+linkname[-2:] == ".//."):
-                    if not os.path.exists(pub_path):
-                        utils.makedirs(pub_path)
-                elif os.path.isfile(path) or os.path.islink(path):
-                    if globls.force:
-                        utils.remove(pub_path)
-                    utils.symlink(path, pub_path)
-
-            package.execute_script("post-publish", self)
-            
-            self.add_published(package.path, platform)
-            self.remove_broken(package.path)
+            self._forget_publish_shadow(platform)
+            index = self.get_publish_index(platform)
+            if plan == None:
+                plan = self._get_publish_plan(package)
+            self._check_publish_conflicts(pub_dir, index, plan, records.keys())
+
+            # current target of links owned by package or old_packages
+            linknames = {}
+            dir_paths = set()
+            for record in records.values():
+                for type, rel_path, linkname in record:
+                    if type == "d":
+                        dir_paths.add(rel_path)
+                    elif index.get(rel_path) in records:
+                        linknames[rel_path] = linkname
+            owners = set(records.keys()+[package.name])
+
+            try:
+                inst_packages = [self._find_package(old_package.name) for old_package in old_packages]
+                for inst_package, old_package in zip(inst_packages, old_packages):
+                    inst_package.execute_script("pre-unpublish", old_package.domain)
+                package.execute_script("pre-publish", self)
+
+                try:
+                    new_paths = dict([(rel_path, path) for type, rel_path, path in plan if type == "l"])
+                    for rel_path in linknames.keys():
+                        if rel_path not in new_paths:
+                            pub_path = os.path.join(pub_dir, rel_path)
+                            try:
+                                if os.readlink(pub_path) == linknames[rel_path]:
+                                    utils.remove(pub_path)
+                            except OSError:
+                                pass
+                            del linknames[rel_path]
+                            del index[rel_path]
+                            dir_paths.add(os.path.dirname(rel_path))
+
+                    for type, rel_path, path in plan:
+                        pub_path = os.path.join(pub_dir, rel_path)
+                        if type == "d":
+                            if not os.path.exists(pub_path):
+                                utils.makedirs(pub_path)
+                                dir_paths.add(rel_path)
+                            continue
+                        if linknames.get(rel_path) == path:
+                            pass
+                        elif os.path.lexists(pub_path):
+                            # replace in place
+                            tmp_path = "%s.tmp.%s" % (pub_path, os.getpid())
+                            utils.symlink(path, tmp_path)
+                            utils.rename(tmp_path, pub_path)
+                        else:
+                            utils.symlink(path, pub_path)
+                        linknames[rel_path] = path
+                        index[rel_path] = package.name
+
+                    # directories left empty and no longer published,
+                    # deepest first
+                    plan_paths = set([os.path.join(pub_dir, rel_path) for type, rel_path, path in plan if type == "d"])
+                    for rel_path in sorted(dir_paths, reverse=True):
+                        path = os.path.join(pub_dir, rel_path)
+                        while path.startswith(pub_dir+"/") and path not in plan_paths \
+                                and os.path.isdir(path) and not os.path.islink(path) \
+                                and not os.listdir(path):
+                            utils.rmdir(path)
+                            path = os.path.dirname(path)
+                finally:
+                    # directories go to package; links to their owner
+                    entries = dict([(name, []) for name in owners])
+                    for rel_path in sorted(dir_paths):
+                        if rel_path and os.path.isdir(os.path.join(pub_dir, rel_path)):
+                            entries[package.name].append(("d", rel_path, ""))
+                    for rel_path, linkname in sorted(linknames.items()):
+                        owner = index.get(rel_path)
+                        if owner in entries:
+                            entries[owner].append(("l", rel_path, linkname))
+                    for name, name_entries in entries.items():
+                        if name == package.name or [1 for entry in name_entries if entry[0] == "l"]:
+                            self.set_publish_record(name, platform, name_entries)
+                        else:
+                            self.remove_publish_record(name, platform)
+                    self.set_publish_index(platform, index)
+
+                for inst_package, old_package in zip(inst_packages, old_packages):
+                    inst_package.execute_script("post-unpublish", old_package.domain)
+                    self.remove_published(old_package.path, platform)
+                package.execute_script("post-publish", self)
+
+                self.add_published(package.path, platform)
+                self.remove_broken(package.path)
+            except:
+                if globls.debug:
+                    traceback.print_exc()
+                self.add_broken(package.path)
+                raise utils.SSMExitException("error: could not publish")
+        finally:
+            self._unlock_publish_index(platform)
+
+    def start_publish(self, platform):
+        """Start a publish transaction on platform. Until
+        commit_publish() (or abort_publish()), publish_package() and
+        unpublish_package() work on a shadow copy of the platform
+        directory (unchanged links are recreated, files hardlinked),
+        the publish records, index and states are only updated on
+        commit, and the publish index stays locked.
+
+        The shadow directory kept by the last commit_publish() is
+        brought up to date, at the cost of what that transaction
+        changed; it is cloned anew only if missing or if the platform
+        directory was changed otherwise since.
+
+        Packages with publish/unpublish scripts are refused (see
+        _check_transaction_scripts()).
+        """
+        if platform in self.transactions:
+            raise utils.SSMExitException("error: already publishing to platform (%s)" % platform)
+        pub_dir = os.path.join(self.path, platform)
+        if os.path.islink(pub_dir):
+            raise utils.SSMExitException("error: cannot publish atomically to symlinked platform directory (%s)" % pub_dir)
+        shadow_dir = os.path.join(self.path, ".%s.publishing" % platform)
+
+        self._lock_publish_index(platform)
+        try:
+            index = self.get_publish_index(platform)
+            if not os.path.isdir(pub_dir) \
+                    or not self._sync_publish_shadow(platform, pub_dir, shadow_dir, index):
+                for path in [shadow_dir, shadow_dir+".old"]:
+                    # left by an interrupted transaction
+                    if os.path.lexists(path):
+                        utils.rmtree(path)
+                if os.path.isdir(pub_dir):
+                    utils.clonetree(pub_dir, shadow_dir, "hardlink")
+                else:
+                    utils.makedirs(shadow_dir)
         except:
-            if globls.debug:
-                traceback.print_exc()
-            self.add_broken(package.path)
-            raise utils.SSMExitException("error: could not publish")
+            self._unlock_publish_index(platform)
+            raise
+        self.transactions[platform] = {
+            "deferred": [],
+            "index": index,
+            "records": {},
+            "shadow_dir": shadow_dir,
+            "untracked": False,
+        }
 
     def unfreeze(self):
         """Remove "frozen" mark.
         """
         utils.remove(self.frozen_path)
 
-    def unpublish_package(self, package, platform=None):
-        """Unpublish package from domain.
+    def _unpublish_recorded(self, pub_dir, record):
+        """Remove the links and directories of a publish record from
+        pub_dir. Links since replaced (e.g., by another package) are
+        left alone. Directories left empty are removed, up to (not
+        including) pub_dir.
+        """
+        dir_paths = set()
+        for type, rel_path, linkname in record:
+            pub_path = os.path.join(pub_dir, rel_path)
+            if type == "d":
+                dir_paths.add(pub_path)
+                continue
+            try:
+                if os.readlink(pub_path) != linkname:
+                    utils.print_warning("warning: skipping link not published by package (%s)" % pub_path)
+                    continue
+            except OSError:
+                # already removed
+                continue
+            utils.remove(pub_path)
+            dir_paths.add(os.path.dirname(pub_path))
+
+        # deepest first
+        for path in sorted(dir_paths, reverse=True):
+            while path.startswith(pub_dir+"/") and os.path.isdir(path) \
+                    and not os.path.islink(path) and not os.listdir(path):
+                utils.rmdir(path)
+                path = os.path.dirname(path)
+
+    def _unpublish_walk(self, pub_dir, package):
+        """Remove the links to package from pub_dir by walking all of
+        it, as well as all empty directories.
 
         Match tail of published links against <package_name>/<tail> .
 
@@ -510,42 +1243,74 @@ class Domain:
             want to resolve only the published one, therefore using
             os.readlink(pub_path).
         """
+        pub_dir_len = len(pub_dir)
+        for root, dirnames, filenames in os.walk(pub_dir, topdown=False):
+            for name in dirnames:
+                pub_path = os.path.join(root, name)
+                if os.path.islink(pub_path):
+                    link_path = os.readlink(pub_path)
+                    if not link_path.startswith("/"):
+                        link_path = os.path.join(os.path.dirname(pub_path), link_path)
+                    if os.path.islink(link_path):
+                        # publish symlink to install symlink to a dir
+                        filenames.append(name)
+                elif len(os.listdir(pub_path)) == 0:
+                    utils.rmdir(pub_path)
+            for name in filenames:
+                pub_path = os.path.join(root, name)
+                tail_pub_path = pub_path[pub_dir_len+1:]
+                match_path = os.path.join(package.name, tail_pub_path)
+                try:
+                    real_pub_path = os.readlink(pub_path)
+                except:
+                    utils.print_warning("warning: skipping unexpected non-symlink file (%s)" % pub_path)
+                    continue
+
+                if real_pub_path.endswith(match_path):
+                    utils.remove(pub_path)
+
+    def unpublish_package(self, package, platform=None):
+        """Unpublish package from domain. Only what was recorded when
+        publishing (see publish_package()) is removed; packages
+        published without a record are handled by walking the
+        platform directory.
+        """
         if self.is_frozen():
             raise utils.SSMExitException("error: domain is frozen")
+        if platform == None:
+            platform = package.platform
+        self._check_transaction_scripts(platform, package, ["pre-unpublish", "post-unpublish"])
 
         try:
             inst_package = self._find_package(package.name)
             inst_package.execute_script("pre-unpublish", package.domain)
 
-            if platform == None:
-                package.platform
-            pub_dir = os.path.join(self.path, platform)
-            pub_dir_len = len(pub_dir)
-            for root, dirnames, filenames in os.walk(pub_dir, topdown=False):
-                for name in dirnames:
-                    pub_path = os.path.join(root, name)
-                    if os.path.islink(pub_path):
-                        link_path = os.readlink(pub_path)
-                        if not link_path.startswith("/"):
-                            link_path = os.path.join(os.path.dirname(pub_path), link_path)
-                        if os.path.islink(link_path):
-                            # publish symlink to install symlink to a dir
-                            filenames.append(name)
-                    elif len(os.listdir(pub_path)) == 0:
-                        utils.rmdir(pub_path)
-                for name in filenames:
-                    pub_path = os.path.join(root, name)
-                    tail_pub_path = pub_path[pub_dir_len+1:]
-                    match_path = os.path.join(package.name, tail_pub_path)
-                    try:
-                        real_pub_path = os.readlink(pub_path)
-                    except:
-                        utils.print_warning("warning: skipping unexpected non-symlink file (%s)" % pub_path)
-                        continue
+            pub_dir = self._get_publish_dir(platform)
+            self._lock_publish_index(platform)
+            try:
+                self._forget_publish_shadow(platform)
+                index = self.get_publish_index(platform)
+                record = self.get_publish_record(package.name, platform)
+                if record != None:
+                    self._unpublish_recorded(pub_dir, record)
+                    # only the recorded links can be owned by package
+                    for type, rel_path, linkname in record:
+                        if type == "l" and index.get(rel_path) == package.name:
+                            del index[rel_path]
+                else:
+                    utils.print_verbose("no publish record, walking (%s)" % pub_dir)
+                    self._unpublish_walk(pub_dir, package)
+                    if platform in self.transactions:
+                        # changed paths unknown
+                        self.transactions[platform]["untracked"] = True
+                    for rel_path, owner in index.items():
+                        if owner == package.name:
+                            del index[rel_path]
+                self.remove_publish_record(package.name, platform)
+                self.set_publish_index(platform, index)
+            finally:
+                self._unlock_publish_index(platform)
 
-                    if real_pub_path.endswith(match_path):
-                        utils.remove(pub_path)
-            
             inst_package.execute_script("post-unpublish", package.domain)
             self.remove_published(package.path, platform)
             self.remove_broken(package.path)
@@ -555,6 +1320,18 @@ class Domain:
             self.add_broken(package.path)
             raise utils.SSMExitException("error: could not unpublish")
 
+    def unpublish_packages(self, packages, platform):
+        """Unpublish packages from platform under a single lock of the
+        publish index.
+        """
+        self._lock_publish_index(platform)
+        try:
+            for package in packages:
+                utils.print_verbose("unpublishing package (%s)" % package.name)
+                self.unpublish_package(package, platform)
+        finally:
+            self._unlock_publish_index(platform)
+
     def update_support(self):
         """Update domain with new items.
         """
@@ -85,6 +85,9 @@ import struct
 import copy
 import re
 import operator
+import threading
+import Queue
+import mmap
 
 # enhance os for SSM
 os.SEEK_SET = 0
@@ -103,8 +106,27 @@ try:
 except ImportError:
     grp = pwd = None
 
+# In-kernel copy between files (copy_file_range, sendfile) for
+# extraction from uncompressed archives; Linux only.
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+    except (ImportError, OSError):
+        _libc = None
+if _libc is not None:
+    if hasattr(_libc, "copy_file_range"):
+        _libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+            ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t, ctypes.c_uint]
+        _libc.copy_file_range.restype = ctypes.c_ssize_t
+    if hasattr(_libc, "sendfile64"):
+        _libc.sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+            ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        _libc.sendfile64.restype = ctypes.c_ssize_t
+
 # from tarfile import *
-__all__ = ["TarFile", "TarInfo", "is_tarfile", "TarError"]
+__all__ = ["TarFile", "TarInfo", "CompactTarInfo", "is_tarfile", "TarError"]
 
 #---------------------------------------------------------
 # tar constants
@@ -288,6 +310,33 @@ def uts(s, encoding, errors):
     else:
         return s.encode(encoding, errors)
 
+# ustar header fields: name, mode, uid, gid, size, mtime, chksum, type,
+# linkname, magic, version, uname, gname, devmajor, devminor, prefix
+HEADER_STRUCT = struct.Struct("100s8s8s8s12s12s8sc100s6s2s32s32s8s8s155s12x")
+EMPTY_BLOCK = NUL * BLOCKSIZE
+
+def nti_fast(s):
+    """Convert a number field to a python number, like nti(), trying the
+       common octal encoding first.
+    """
+    try:
+        return int(s.rstrip(" \0") or "0", 8)
+    except ValueError:
+        return nti(s)
+
+def check_chksum(buf, chksum):
+    """Return whether chksum is the checksum of header buf (see
+       calc_chksums()). The unsigned checksum is computed in one pass,
+       the signed one only if the unsigned one does not match.
+    """
+    b = bytearray(buf)
+    unsigned_chksum = 256 + sum(b) - sum(b[148:156])
+    if chksum == unsigned_chksum:
+        return True
+    # Each char with the high bit set counts 256 less when signed.
+    high = len([c for c in b[:148] if c >= 128]) + len([c for c in b[156:] if c >= 128])
+    return chksum == unsigned_chksum - 256 * high
+
 def calc_chksums(buf):
     """Calculate the checksum for a member's header by summing up all
        characters except for the chksum field which is treated as if
@@ -301,28 +350,120 @@ def calc_chksums(buf):
     signed_chksum = 256 + sum(struct.unpack("148b", buf[:148]) + struct.unpack("356b", buf[156:512]))
     return unsigned_chksum, signed_chksum
 
-def copyfileobj(src, dst, length=None):
+COPY_BUFSIZE = 1024 * 1024     # chunk size used to copy member data
+
+# errnos for which an in-kernel copy is not possible (nothing copied)
+COPYFD_ERRNOS = (errno.ENOSYS, errno.EINVAL, errno.EXDEV, errno.EBADF,
+                 getattr(errno, "EOPNOTSUPP", errno.EINVAL))
+
+def copyfd(srcfd, offset, dstfd, length):
+    """Copy length bytes from offset in file descriptor srcfd to the
+       current position of file descriptor dstfd, in the kernel
+       (copy_file_range, else sendfile), without changing the position
+       of srcfd. Return False if neither is available or supported by
+       the files (nothing is copied then).
+    """
+    if _libc is None:
+        return False
+    off = ctypes.c_int64(offset)
+    end = offset + length
+    for func in ("copy_file_range", "sendfile64"):
+        if not hasattr(_libc, func):
+            continue
+        while off.value < end:
+            count = min(end - off.value, 1 << 30)
+            if func == "copy_file_range":
+                n = _libc.copy_file_range(srcfd, ctypes.byref(off), dstfd, None, count, 0)
+            else:
+                n = _libc.sendfile64(dstfd, srcfd, ctypes.byref(off), count)
+            if n < 0:
+                e = ctypes.get_errno()
+                if e == errno.EINTR:
+                    continue
+                if off.value == offset and e in COPYFD_ERRNOS:
+                    break
+                raise IOError(e, os.strerror(e))
+            elif n == 0:
+                raise IOError("end of file reached")
+        else:
+            return True
+    return False
+
+def copyrange(src, offset, dst, length, buf, lock=None, digest=None):
+    """Copy length bytes from offset in file src to file dst, reading
+       into the reusable bytearray buf. If lock is given, it is held
+       while src is positioned and read (src is shared by threads).
+       The data is also fed to the hash object digest, if given.
+    """
+    view = memoryview(buf)
+    while length > 0:
+        if lock:
+            lock.acquire()
+        try:
+            src.seek(offset)
+            n = src.readinto(view[:min(length, len(buf))])
+        finally:
+            if lock:
+                lock.release()
+        if not n:
+            raise IOError("end of file reached")
+        if digest is not None:
+            digest.update(view[:n])
+        dst.write(view[:n])
+        offset += n
+        length -= n
+
+def copymap(src, offset, dst, length, digest=None):
+    """Copy length bytes from offset in the mmap src to file dst,
+       writing slices of the mapping without intermediate strings.
+       The data is also fed to the hash object digest, if given.
+    """
+    if offset + length > len(src):
+        raise IOError("end of file reached")
+    while length > 0:
+        n = min(length, COPY_BUFSIZE)
+        buf = buffer(src, offset, n)
+        if digest is not None:
+            digest.update(buf)
+        dst.write(buf)
+        offset += n
+        length -= n
+
+def copyfileobj(src, dst, length=None, digest=None):
     """Copy length bytes from fileobj src to fileobj dst.
-       If length is None, copy the entire content.
+       If length is None, copy the entire content. The data is also
+       fed to the hash object digest, if given.
     """
     if length == 0:
         return
     if length is None:
-        shutil.copyfileobj(src, dst)
+        if digest is None:
+            shutil.copyfileobj(src, dst, COPY_BUFSIZE)
+            return
+        while True:
+            buf = src.read(COPY_BUFSIZE)
+            if not buf:
+                break
+            digest.update(buf)
+            dst.write(buf)
         return
 
-    BUFSIZE = 16 * 1024
+    BUFSIZE = COPY_BUFSIZE
     blocks, remainder = divmod(length, BUFSIZE)
     for b in xrange(blocks):
         buf = src.read(BUFSIZE)
         if len(buf) < BUFSIZE:
             raise IOError("end of file reached")
+        if digest is not None:
+            digest.update(buf)
         dst.write(buf)
 
     if remainder != 0:
         buf = src.read(remainder)
         if len(buf) < remainder:
             raise IOError("end of file reached")
+        if digest is not None:
+            digest.update(buf)
         dst.write(buf)
     return
 
@@ -392,6 +533,228 @@ class HeaderError(TarError):
     """Exception for invalid headers."""
     pass
 
+#---------------------------
+# optional compression types
+#---------------------------
+XZ_MAGIC = "\xfd7zXZ\x00"      # magic of xz compressed data
+ZSTD_MAGIC = "\x28\xb5\x2f\xfd" # magic of zstd compressed data
+ZSTD_SKIPPABLE_MAGICS = tuple([chr(0x50 + i) + "\x2a\x4d\x18" for i in range(16)])
+                                # magics of zstd skippable frames, which
+                                # may come first (e.g., pzstd)
+ZSTD_MAGICS = (ZSTD_MAGIC,) + ZSTD_SKIPPABLE_MAGICS
+
+def _get_lzma():
+    """Return the lzma module (python 3 or backports.lzma).
+    """
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise CompressionError("lzma module is not available")
+    return lzma
+
+def _get_zstandard():
+    """Return the zstandard module.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise CompressionError("zstandard module is not available")
+    return zstandard
+
+def _compressobj(comptype, compresslevel=None, jobs=None):
+    """Return a compressor (with compress() and flush()) for comptype
+       "xz" or "zst". A zstd compressor uses jobs threads, if more than
+       one.
+    """
+    if comptype == "xz":
+        lzma = _get_lzma()
+        if compresslevel is None:
+            return lzma.LZMACompressor()
+        return lzma.LZMACompressor(preset=compresslevel)
+    elif comptype == "zst":
+        zstandard = _get_zstandard()
+        kwargs = {}
+        if compresslevel is not None:
+            kwargs["level"] = compresslevel
+        if jobs > 1:
+            kwargs["threads"] = jobs
+        return zstandard.ZstdCompressor(**kwargs).compressobj()
+    raise CompressionError("unknown compression type %r" % comptype)
+
+def _decompressreader(comptype, read, blocksize=64 * 1024):
+    """Return a reader (with read(size)) of the data decompressed from
+       what the function read(size) returns, for comptype "xz" or
+       "zst". All streams (xz) or frames (zst) of the data are
+       decompressed, e.g., as written by pxz or pzstd or concatenated.
+    """
+    if comptype == "xz":
+        return _XzReader(read, blocksize)
+    elif comptype == "zst":
+        return _ZstdReader(read, blocksize)
+    raise CompressionError("unknown compression type %r" % comptype)
+
+class _XzReader(object):
+    """Reader of the data of one or more xz streams, which may be
+       separated by stream padding (NULs). Raises ReadError on invalid
+       or trailing data and on a truncated stream.
+    """
+
+    def __init__(self, read, blocksize):
+        self.lzma = _get_lzma()
+        self.rawread = read
+        self.blocksize = blocksize
+        self.cmp = self.lzma.LZMADecompressor()
+        self.pending = False    # current stream is incomplete
+        self.buf = ""
+
+    def decompress(self, data):
+        b = []
+        while data:
+            if self.cmp.eof:
+                data = data.lstrip(NUL)
+                if not data:
+                    break
+                self.cmp = self.lzma.LZMADecompressor()
+            try:
+                b.append(self.cmp.decompress(data))
+            except (EOFError, self.lzma.LZMAError):
+                raise ReadError("invalid compressed data")
+            self.pending = not self.cmp.eof
+            data = self.cmp.eof and self.cmp.unused_data or ""
+        return "".join(b)
+
+    def read(self, size):
+        b = [self.buf]
+        x = len(self.buf)
+        while x < size:
+            raw = self.rawread(self.blocksize)
+            if not raw:
+                if self.pending:
+                    raise ReadError("unexpected end of compressed data")
+                break
+            data = self.decompress(raw)
+            b.append(data)
+            x += len(data)
+        self.buf = "".join(b)
+
+        buf = self.buf[:size]
+        self.buf = self.buf[size:]
+        return buf
+
+class _ZstdReader(object):
+    """Reader of the data of one or more zstd frames. Raises ReadError
+       on invalid or trailing data and on a truncated frame (the
+       decompressor does not tell, so frame boundaries are tracked by
+       a _ZstdFrameScanner).
+    """
+
+    def __init__(self, read, blocksize):
+        zstandard = _get_zstandard()
+        self.error = zstandard.ZstdError
+        self.rawread = read
+        self.scanner = _ZstdFrameScanner()
+        self.reader = zstandard.ZstdDecompressor().stream_reader(
+            _FuncFile(self._read), read_size=blocksize,
+            read_across_frames=True)
+
+    def _read(self, size):
+        data = self.rawread(size)
+        self.scanner.feed(data)
+        return data
+
+    def read(self, size):
+        b = []
+        x = 0
+        while x < size:
+            try:
+                data = self.reader.read(size - x)
+            except self.error:
+                raise ReadError("invalid compressed data")
+            if not data:
+                if not self.scanner.complete():
+                    raise ReadError("unexpected end of compressed data")
+                break
+            b.append(data)
+            x += len(data)
+        return "".join(b)
+
+class _ZstdFrameScanner(object):
+    """Follow the frame, block and skippable frame headers of zstd data
+       fed to it, to tell whether the data ends between frames.
+       Invalid data is left to the decompressor.
+    """
+
+    def __init__(self):
+        self.state = "magic"
+        self.need = 4           # length of the next header
+        self.head = ""
+        self.skip = 0           # length of data to skip first
+        self.checksum = False
+
+    def feed(self, data):
+        pos = 0
+        n = len(data)
+        while pos < n and self.state != "invalid":
+            if self.skip:
+                k = min(self.skip, n - pos)
+                self.skip -= k
+                pos += k
+                continue
+            k = min(self.need - len(self.head), n - pos)
+            self.head += data[pos:pos + k]
+            pos += k
+            if len(self.head) == self.need:
+                head, self.head = self.head, ""
+                self._parse(head)
+
+    def _parse(self, head):
+        if self.state == "magic":
+            if head == ZSTD_MAGIC:
+                self.state, self.need = "frame", 1
+            elif head in ZSTD_SKIPPABLE_MAGICS:
+                self.state, self.need = "skippable", 4
+            else:
+                self.state = "invalid"
+        elif self.state == "skippable":
+            self.skip = struct.unpack("<L", head)[0]
+            self.state, self.need = "magic", 4
+        elif self.state == "frame":
+            fhd = ord(head)
+            fcs_flag = fhd >> 6
+            single_segment = fhd & 0x20
+            self.checksum = bool(fhd & 0x04)
+            self.skip = (not single_segment and 1 or 0) \
+                + (0, 1, 2, 4)[fhd & 0x03] \
+                + (single_segment and 1 or 0, 2, 4, 8)[fcs_flag]
+            self.state, self.need = "block", 3
+        elif self.state == "block":
+            bh = struct.unpack("<L", head + NUL)[0]
+            last = bh & 1
+            btype = (bh >> 1) & 3
+            if btype == 3:
+                self.state = "invalid"
+                return
+            self.skip = btype == 1 and 1 or bh >> 3
+            if last:
+                self.skip += self.checksum and 4 or 0
+                self.state, self.need = "magic", 4
+
+    def complete(self):
+        """Return whether the data fed so far ends between frames.
+        """
+        return self.state == "invalid" or \
+            (self.state == "magic" and not self.head and not self.skip)
+
+class _FuncFile(object):
+    """File-like object whose read() is the function read.
+    """
+
+    def __init__(self, read):
+        self.read = read
+
 #---------------------------
 # internal stream interface
 #---------------------------
@@ -461,7 +824,8 @@ class _Stream:
             self.zlib = zlib
             self.crc = zlib.crc32("") & 0xffffffffL
             if mode == "r":
-                self._init_read_gz()
+                # inflate in other threads (see _GzipReader)
+                self.gzreader = _GzipReader(fileobj)
             else:
                 self._init_write_gz()
 
@@ -476,6 +840,13 @@ class _Stream:
             else:
                 self.cmp = bz2.BZ2Compressor()
 
+        if comptype in ("xz", "zst"):
+            if mode == "r":
+                self.cmpreader = _decompressreader(comptype, self.__read,
+                                                   self.bufsize)
+            else:
+                self.cmp = _compressobj(comptype)
+
     def __del__(self):
         if hasattr(self, "closed") and not self.closed:
             self.close()
@@ -519,6 +890,9 @@ class _Stream:
         if self.closed:
             return
 
+        if self.mode == "r" and self.comptype == "gz":
+            self.gzreader.close()
+
         if self.mode == "w" and self.comptype != "tar":
             self.buf += self.cmp.flush()
 
@@ -540,37 +914,6 @@ class _Stream:
 
         self.closed = True
 
-    def _init_read_gz(self):
-        """Initialize for reading a gzip compressed fileobj.
-        """
-        self.cmp = self.zlib.decompressobj(-self.zlib.MAX_WBITS)
-        self.dbuf = ""
-
-        # taken from gzip.GzipFile with some alterations
-        if self.__read(2) != "\037\213":
-            raise ReadError("not a gzip file")
-        if self.__read(1) != "\010":
-            raise CompressionError("unsupported compression method")
-
-        flag = ord(self.__read(1))
-        self.__read(6)
-
-        if flag & 4:
-            xlen = ord(self.__read(1)) + 256 * ord(self.__read(1))
-            self.read(xlen)
-        if flag & 8:
-            while True:
-                s = self.__read(1)
-                if not s or s == NUL:
-                    break
-        if flag & 16:
-            while True:
-                s = self.__read(1)
-                if not s or s == NUL:
-                    break
-        if flag & 2:
-            self.__read(2)
-
     def tell(self):
         """Return the stream's file pointer position.
         """
@@ -612,6 +955,10 @@ class _Stream:
         """
         if self.comptype == "tar":
             return self.__read(size)
+        if self.comptype == "gz":
+            return self.gzreader.read(size)
+        if self.comptype in ("xz", "zst"):
+            return self.cmpreader.read(size)
 
         c = len(self.dbuf)
         t = [self.dbuf]
@@ -621,7 +968,7 @@ class _Stream:
                 break
             try:
                 buf = self.cmp.decompress(buf)
-            except IOError:
+            except (IOError, EOFError):
                 raise ReadError("invalid compressed data")
             t.append(buf)
             c += len(buf)
@@ -664,6 +1011,10 @@ class _StreamProxy(object):
             return "gz"
         if self.buf.startswith("BZh91"):
             return "bz2"
+        if self.buf.startswith(XZ_MAGIC):
+            return "xz"
+        if self.buf[:4] in ZSTD_MAGICS:
+            return "zst"
         return "tar"
 
     def close(self):
@@ -733,6 +1084,522 @@ class _BZ2Proxy(object):
             self.fileobj.write(raw)
 # class _BZ2Proxy
 
+class _CompressionProxy(object):
+    """Small proxy class, like _BZ2Proxy, for the "r:xz", "w:xz",
+       "r:zst" and "w:zst" modes: the data of fileobj is decompressed
+       on read and compressed on write (see _compressobj() for jobs).
+       fileobj is closed by close() if close_fileobj is set.
+    """
+
+    blocksize = 64 * 1024
+
+    def __init__(self, fileobj, mode, comptype, compresslevel=None,
+                 close_fileobj=False, jobs=None):
+        self.fileobj = fileobj
+        self.mode = mode
+        self.comptype = comptype
+        self.compresslevel = compresslevel
+        self.close_fileobj = close_fileobj
+        self.jobs = jobs
+        self.name = getattr(self.fileobj, "name", None)
+        self.init()
+
+    def init(self):
+        self.pos = 0
+        if self.mode == "r":
+            self.fileobj.seek(0)
+            self.cmpreader = _decompressreader(self.comptype,
+                                               self.fileobj.read,
+                                               self.blocksize)
+        else:
+            self.cmpobj = _compressobj(self.comptype, self.compresslevel,
+                                       self.jobs)
+
+    def read(self, size):
+        buf = self.cmpreader.read(size)
+        self.pos += len(buf)
+        return buf
+
+    def seek(self, pos):
+        if pos < self.pos:
+            self.init()
+        self.read(pos - self.pos)
+
+    def tell(self):
+        return self.pos
+
+    def write(self, data):
+        self.pos += len(data)
+        raw = self.cmpobj.compress(data)
+        self.fileobj.write(raw)
+
+    def close(self):
+        if self.mode == "w":
+            raw = self.cmpobj.flush()
+            self.fileobj.write(raw)
+        if self.close_fileobj:
+            self.fileobj.close()
+# class _CompressionProxy
+
+#------------------------
+# threaded gzip reading
+#------------------------
+GZIP_MAGIC = "\037\213"
+GZIP_SIZE_SUBFIELD = "SZ"       # gzip extra subfield holding the total
+                                # size of the member (8 bytes, little
+                                # endian), written by 'ssm pack'
+BGZF_SUBFIELD = "BC"            # bgzip subfield: total size - 1 (2 bytes)
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+GZIP_JOBS = min(_cpu_count(), 8)
+                                # threads inflating gzip members of known
+                                # size (see _GzipReader)
+GZIP_CHUNKSIZE = 4 * 1024 * 1024
+                                # data per gzip member (see _GzipWriter)
+
+class _GzipMember(object):
+    """Placeholder for the data of a gzip member being inflated (from
+       raw) by a worker thread of _GzipReader, or deflated (from data)
+       by one of _GzipWriter.
+    """
+
+    def __init__(self, raw=None, data=None):
+        self.raw = raw
+        self.data = data
+        self.error = None
+        self.event = threading.Event()
+
+    def deflate(self, zlib, compresslevel):
+        """Set raw to a complete gzip member, with GZIP_SIZE_SUBFIELD,
+           holding data.
+        """
+        try:
+            try:
+                data = self.data
+                cmp = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                       -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+                body = cmp.compress(data) + cmp.flush()
+                # header: no mtime, unknown OS, one extra subfield
+                extra = GZIP_SIZE_SUBFIELD + struct.pack("<H", 8)
+                size = 10 + 2 + len(extra) + 8 + len(body) + 8
+                self.raw = "".join((GZIP_MAGIC, "\010\004", NUL * 4,
+                    "\000\377", struct.pack("<H", len(extra) + 8), extra,
+                    struct.pack("<Q", size), body,
+                    struct.pack("<LL", zlib.crc32(data) & 0xffffffffL,
+                                len(data) & 0xffffffffL)))
+            except Exception, e:
+                self.error = e
+        finally:
+            self.data = None
+            self.event.set()
+
+    def inflate(self, zlib):
+        try:
+            try:
+                cmp = zlib.decompressobj(-zlib.MAX_WBITS)
+                data = cmp.decompress(self.raw)
+                trailer = cmp.unused_data
+                if len(trailer) != 8:
+                    raise ReadError("invalid compressed data")
+                crc, isize = struct.unpack("<LL", trailer)
+                if crc != zlib.crc32(data) & 0xffffffffL or \
+                        isize != len(data) & 0xffffffffL:
+                    raise ReadError("invalid compressed data")
+                self.data = data
+            except zlib.error:
+                self.error = ReadError("invalid compressed data")
+            except Exception, e:
+                self.error = e
+        finally:
+            self.raw = None
+            self.event.set()
+
+class _GzipReader(object):
+    """Read-only file object decompressing gzip data (one or several
+       concatenated members) from fileobj in background threads, so that
+       inflating overlaps with the processing of the data read:
+       - a reader thread parses the members and inflates them in turn;
+       - members whose size is given in their header (see
+         GZIP_SIZE_SUBFIELD and BGZF_SUBFIELD) are instead read whole
+         and inflated concurrently by up to jobs threads.
+       Seeking forward skips data, seeking backward restarts from the
+       beginning (fileobj must then support seek()).
+    """
+
+    def __init__(self, fileobj, jobs=None, bufsize=RECORDSIZE * 16,
+                 close_fileobj=False):
+        import zlib
+        self.zlib = zlib
+        self.fileobj = fileobj
+        self.close_fileobj = close_fileobj
+        self.jobs = jobs or GZIP_JOBS
+        self.bufsize = bufsize
+        self.name = getattr(fileobj, "name", None)
+        self.closed = False
+        if hasattr(fileobj, "tell"):
+            self.start = fileobj.tell()
+        else:
+            self.start = None
+        self._start()
+
+    def _start(self):
+        self.pos = 0
+        self.buf = ""
+        self.bufpos = 0
+        self.eof = False
+        self.stopped = False
+        self.raw = ""
+        self.queue = Queue.Queue(2 * self.jobs + 2)
+        self.tasks = None
+        self.workers = []
+        self.thread = threading.Thread(target=self._produce)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _stop(self):
+        """Stop the reader and worker threads, if still running, and
+           wait for them to end.
+        """
+        self.stopped = True
+        self.eof = True
+        while True:
+            # keep the queue empty so that the thread is not blocked
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except Queue.Empty:
+                pass
+            if not self.thread.isAlive():
+                break
+            self.thread.join(0.1)
+        for thread in self.workers:
+            thread.join()
+
+    #
+    # reader thread
+    #
+    def _rawread(self, size):
+        """Return size bytes (fewer at end of file) from fileobj.
+        """
+        t = [self.raw]
+        c = len(self.raw)
+        while c < size:
+            buf = self.fileobj.read(max(self.bufsize, size - c))
+            if not buf:
+                break
+            t.append(buf)
+            c += len(buf)
+        t = "".join(t)
+        self.raw = t[size:]
+        return t[:size]
+
+    def _readheader(self, first=False):
+        """Parse the header of the next member. Return None at the end
+           of the data, else the total size of the member, if known,
+           and the size of the header.
+        """
+        buf = self._rawread(10)
+        if len(buf) < 10 or buf[:2] != GZIP_MAGIC:
+            if first:
+                raise ReadError("not a gzip file")
+            # end of data (or trailing garbage, as gzip ignores)
+            return None
+        if buf[2] != "\010":
+            raise CompressionError("unsupported compression method")
+        flag = ord(buf[3])
+        hsize = 10
+        size = None
+        if flag & 4:
+            buf = self._rawread(2)
+            if len(buf) != 2:
+                raise ReadError("unexpected end of data")
+            xlen = struct.unpack("<H", buf)[0]
+            extra = self._rawread(xlen)
+            if len(extra) != xlen:
+                raise ReadError("unexpected end of data")
+            hsize += 2 + xlen
+            pos = 0
+            while pos + 4 <= len(extra):
+                sid = extra[pos:pos+2]
+                slen = struct.unpack("<H", extra[pos+2:pos+4])[0]
+                field = extra[pos+4:pos+4+slen]
+                if len(field) != slen:
+                    raise ReadError("invalid gzip header")
+                if sid == GZIP_SIZE_SUBFIELD and slen == 8:
+                    size = struct.unpack("<Q", field)[0]
+                elif sid == BGZF_SUBFIELD and slen == 2:
+                    size = struct.unpack("<H", field)[0] + 1
+                pos += 4 + slen
+        for f in (8, 16):
+            if flag & f:
+                while True:
+                    s = self._rawread(1)
+                    hsize += 1
+                    if not s or s == NUL:
+                        break
+        if flag & 2:
+            self._rawread(2)
+            hsize += 2
+        if size is not None and size < hsize + 8:
+            # too small for the header it is given in and a trailer
+            raise ReadError("invalid gzip header")
+        return size, hsize
+
+    def _put(self, item):
+        """Queue item for read(). Return False if stopped.
+        """
+        while not self.stopped:
+            try:
+                self.queue.put(item, True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def _work(self):
+        while True:
+            member = self.tasks.get()
+            if member is None:
+                return
+            member.inflate(self.zlib)
+
+    def _produce(self):
+        zlib = self.zlib
+        workers = self.workers
+        try:
+            try:
+                first = True
+                while not self.stopped:
+                    header = self._readheader(first)
+                    first = False
+                    if header is None:
+                        break
+                    size, hsize = header
+
+                    if size is not None and self.jobs > 1:
+                        # inflate whole member in a worker
+                        if self.tasks is None:
+                            self.tasks = Queue.Queue()
+                            for i in xrange(self.jobs):
+                                thread = threading.Thread(target=self._work)
+                                thread.setDaemon(True)
+                                thread.start()
+                                workers.append(thread)
+                        member = _GzipMember(self._rawread(size - hsize))
+                        if not self._put(member):
+                            break
+                        self.tasks.put(member)
+                        continue
+
+                    # inflate member as a stream, here; the last chunk
+                    # is held back until the trailer is checked
+                    cmp = zlib.decompressobj(-zlib.MAX_WBITS)
+                    crc = zlib.crc32("") & 0xffffffffL
+                    isize = 0
+                    last = ""
+                    while not self.stopped:
+                        raw = self._rawread(self.bufsize)
+                        if not raw:
+                            raise ReadError("unexpected end of data")
+                        try:
+                            data = cmp.decompress(raw)
+                        except zlib.error:
+                            raise ReadError("invalid compressed data")
+                        if data:
+                            crc = zlib.crc32(data, crc) & 0xffffffffL
+                            isize += len(data)
+                            if last and not self._put(last):
+                                break
+                            last = data
+                        if cmp.unused_data:
+                            self.raw = cmp.unused_data + self.raw
+                            break
+                    if self.stopped:
+                        break
+                    trailer = self._rawread(8)
+                    if len(trailer) != 8:
+                        raise ReadError("unexpected end of data")
+                    if struct.unpack("<LL", trailer) != (crc, isize & 0xffffffffL):
+                        raise ReadError("invalid compressed data")
+                    if last and not self._put(last):
+                        break
+                self._put(None)
+            except Exception, e:
+                self._put(e)
+        finally:
+            if self.tasks is not None:
+                for thread in workers:
+                    self.tasks.put(None)
+
+    #
+    # file interface
+    #
+    def read(self, size=None):
+        """Read at most size bytes (all if None).
+        """
+        buf = self.buf
+        bufpos = self.bufpos
+        if size is not None and len(buf) - bufpos >= size:
+            # avoid copying the rest of a large chunk on small reads
+            self.bufpos += size
+            self.pos += size
+            return buf[bufpos:bufpos+size]
+
+        t = [buf[bufpos:]]
+        c = len(t[0])
+        while (size is None or c < size) and not self.eof:
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+                break
+            elif isinstance(item, Exception):
+                self.eof = True
+                raise item
+            elif isinstance(item, _GzipMember):
+                item.event.wait()
+                if item.error:
+                    self.eof = True
+                    raise item.error
+                item = item.data
+            t.append(item)
+            c += len(item)
+        t = "".join(t)
+        if size is None:
+            size = len(t)
+        self.buf = t
+        self.bufpos = min(size, len(t))
+        self.pos += self.bufpos
+        return t[:size]
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence != 0:
+            raise IOError("unsupported seek")
+        if pos < self.pos:
+            if self.start is None:
+                raise StreamError("seeking backwards is not allowed")
+            self._stop()
+            self.fileobj.seek(self.start)
+            self._start()
+        while self.pos < pos:
+            if not self.read(min(pos - self.pos, self.bufsize)):
+                break
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if not self.closed:
+            self._stop()
+            if self.close_fileobj:
+                self.fileobj.close()
+            self.closed = True
+# class _GzipReader
+
+class _GzipWriter(object):
+    """Write-only file object compressing data to fileobj as
+       concatenated gzip members of GZIP_CHUNKSIZE bytes of data. Each
+       member is independent and records its size (GZIP_SIZE_SUBFIELD),
+       so that _GzipReader can inflate several at once. Up to jobs
+       members are deflated concurrently by worker threads; the output
+       does not depend on jobs.
+    """
+
+    def __init__(self, fileobj, compresslevel=9, jobs=None,
+                 chunksize=GZIP_CHUNKSIZE, close_fileobj=False):
+        import zlib
+        self.zlib = zlib
+        self.fileobj = fileobj
+        self.compresslevel = compresslevel
+        self.jobs = jobs or GZIP_JOBS
+        self.chunksize = chunksize
+        self.close_fileobj = close_fileobj
+        self.name = getattr(fileobj, "name", None)
+        self.closed = False
+        self.pos = 0
+        self.buf = []
+        self.bufsize = 0
+        self.pending = []       # members in output order
+        self.tasks = None
+        self.workers = []
+
+    def _work(self):
+        while True:
+            member = self.tasks.get()
+            if member is None:
+                return
+            member.deflate(self.zlib, self.compresslevel)
+
+    def _deflate(self, data):
+        """Queue data as the next member.
+        """
+        member = _GzipMember(data=data)
+        if self.jobs <= 1:
+            member.deflate(self.zlib, self.compresslevel)
+        else:
+            if self.tasks is None:
+                self.tasks = Queue.Queue()
+                for i in xrange(self.jobs):
+                    thread = threading.Thread(target=self._work)
+                    thread.setDaemon(True)
+                    thread.start()
+                    self.workers.append(thread)
+            self.tasks.put(member)
+        self.pending.append(member)
+        # bound memory: keep at most 2 members per job in flight
+        self._writepending(len(self.pending) - 2 * self.jobs)
+
+    def _writepending(self, count):
+        """Write the first count pending members to fileobj.
+        """
+        for i in xrange(count):
+            member = self.pending.pop(0)
+            member.event.wait()
+            if member.error:
+                raise member.error
+            self.fileobj.write(member.raw)
+            member.raw = None
+
+    def write(self, s):
+        self.buf.append(s)
+        self.bufsize += len(s)
+        self.pos += len(s)
+        if self.bufsize >= self.chunksize:
+            data = "".join(self.buf)
+            n = len(data) - len(data) % self.chunksize
+            for i in xrange(0, n, self.chunksize):
+                self._deflate(data[i:i+self.chunksize])
+            self.buf = [data[n:]]
+            self.bufsize = len(data) - n
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.bufsize or not self.pos:
+                # an empty file still gets one (empty) member
+                self._deflate("".join(self.buf))
+            self._writepending(len(self.pending))
+        finally:
+            for thread in self.workers:
+                self.tasks.put(None)
+            for thread in self.workers:
+                thread.join()
+            if self.close_fileobj:
+                self.fileobj.close()
+# class _GzipWriter
+
 #------------------------
 # Extraction file object
 #------------------------
@@ -943,14 +1810,14 @@ class ExFileObject(object):
 #------------------
 # Exported Classes
 #------------------
-class TarInfo(object):
-    """Informational class which holds the details about an
-       archive member given by a tar header block.
-       TarInfo objects are returned by TarFile.getmember(),
-       TarFile.getmembers() and TarFile.gettarinfo() and are
-       usually created internally.
+class _TarInfoBase(object):
+    """Implementation shared by TarInfo and CompactTarInfo. It has no
+       instance dictionary of its own so that subclasses may use
+       __slots__.
     """
 
+    __slots__ = ()
+
     def __init__(self, name=""):
         """Construct a TarInfo object. name is the optional name
            of the member.
@@ -1235,29 +2102,35 @@ class TarInfo(object):
         """
         if len(buf) != BLOCKSIZE:
             raise HeaderError("truncated header")
-        if buf.count(NUL) == BLOCKSIZE:
+        if buf == EMPTY_BLOCK:
             raise HeaderError("empty header")
 
-        chksum = nti(buf[148:156])
-        if chksum not in calc_chksums(buf):
+        # Decode all fields at once.
+        name, mode, uid, gid, size, mtime, chksum, type, linkname, magic, \
+            version, uname, gname, devmajor, devminor, prefix \
+            = HEADER_STRUCT.unpack(buf)
+
+        chksum = nti_fast(chksum)
+        if not check_chksum(buf, chksum):
             raise HeaderError("bad checksum")
 
         obj = cls()
         obj.buf = buf
-        obj.name = nts(buf[0:100])
-        obj.mode = nti(buf[100:108])
-        obj.uid = nti(buf[108:116])
-        obj.gid = nti(buf[116:124])
-        obj.size = nti(buf[124:136])
-        obj.mtime = nti(buf[136:148])
+        obj.name = nts(name)
+        obj.mode = nti_fast(mode)
+        obj.uid = nti_fast(uid)
+        obj.gid = nti_fast(gid)
+        obj.size = nti_fast(size)
+        obj.mtime = nti_fast(mtime)
         obj.chksum = chksum
-        obj.type = buf[156:157]
-        obj.linkname = nts(buf[157:257])
-        obj.uname = nts(buf[265:297])
-        obj.gname = nts(buf[297:329])
-        obj.devmajor = nti(buf[329:337])
-        obj.devminor = nti(buf[337:345])
-        prefix = nts(buf[345:500])
+        obj.type = type
+        obj.linkname = nts(linkname)
+        # Few distinct owners, many members.
+        obj.uname = intern(nts(uname))
+        obj.gname = intern(nts(gname))
+        obj.devmajor = nti_fast(devmajor)
+        obj.devminor = nti_fast(devminor)
+        prefix = nts(prefix)
 
         # Old V7 tar format represents a directory as a regular
         # file with a trailing slash.
@@ -1515,8 +2388,54 @@ class TarInfo(object):
         return self.type == GNUTYPE_SPARSE
     def isdev(self):
         return self.type in (CHRTYPE, BLKTYPE, FIFOTYPE)
+# class _TarInfoBase
+
+class TarInfo(_TarInfoBase):
+    """Informational class which holds the details about an
+       archive member given by a tar header block.
+       TarInfo objects are returned by TarFile.getmember(),
+       TarFile.getmembers() and TarFile.gettarinfo() and are
+       usually created internally.
+    """
 # class TarInfo
 
+EMPTY_PAX_HEADERS = {}          # Shared by CompactTarInfo objects without
+                                # pax headers; must not be modified.
+
+class CompactTarInfo(_TarInfoBase):
+    """TarInfo using __slots__, for archives with many members: there
+       is no instance dictionary (no extra attributes may be set), the
+       header buffer is not kept once the member is processed and
+       members without pax headers share EMPTY_PAX_HEADERS. Use with
+       TarFile(tarinfo=CompactTarInfo).
+    """
+
+    __slots__ = ("name", "mode", "uid", "gid", "size", "mtime", "chksum",
+                 "type", "linkname", "uname", "gname", "devmajor",
+                 "devminor", "offset", "offset_data", "pax_headers",
+                 "buf", "sparse", "tarfile", "_link_target")
+
+    def __init__(self, name=""):
+        _TarInfoBase.__init__(self, name)
+        self.pax_headers = EMPTY_PAX_HEADERS
+
+    #@classmethod
+    def fromtarfile(cls, tarfile):
+        """Return the next CompactTarInfo object from TarFile object
+           tarfile.
+        """
+        obj = super(CompactTarInfo, cls).fromtarfile(tarfile)
+        if obj is not None:
+            obj.buf = None
+        return obj
+    fromtarfile = classmethod(fromtarfile)
+
+    def _apply_pax_info(self, pax_headers, encoding, errors):
+        _TarInfoBase._apply_pax_info(self, pax_headers, encoding, errors)
+        if not self.pax_headers:
+            self.pax_headers = EMPTY_PAX_HEADERS
+# class CompactTarInfo
+
 class TarFile(object):
     """The TarFile Class provides an interface to tar archives.
     """
@@ -1543,9 +2462,36 @@ class TarFile(object):
 
     fileobject = ExFileObject   # The default ExFileObject class to use.
 
+    retain_members = True       # If false, members read by next() are not
+                                # kept in self.members, so that an archive
+                                # can be processed in a single pass using
+                                # constant memory; getmembers() and
+                                # getmember() are then unavailable.
+
+    defer_metadata = False      # If true, extract() applies owner and mode
+                                # of regular files through the open file
+                                # descriptor (fchown/fchmod) and defers the
+                                # metadata of directories until
+                                # apply_deferred_metadata() is called.
+
+    use_mmap = False            # If true, an uncompressed archive file
+                                # opened for reading is mapped in memory:
+                                # headers and extractfile() data are read
+                                # from the mapping rather than through
+                                # file buffers.
+
+    digest = None               # If set to a hash constructor (e.g.,
+                                # hashlib.md5), extract() hashes the data
+                                # of each regular file as it is written
+                                # (rather than copying it in the kernel)
+                                # and records the hex digest in
+                                # self.digests, by member name.
+
     def __init__(self, name=None, mode="r", fileobj=None, format=None,
             tarinfo=None, dereference=None, ignore_zeros=None, encoding=None,
-            errors=None, pax_headers=None, debug=None, errorlevel=None):
+            errors=None, pax_headers=None, debug=None, errorlevel=None,
+            retain_members=None, defer_metadata=None, use_mmap=None,
+            digest=None):
         """Open an (uncompressed) tar archive `name'. `mode' is either 'r' to
            read from an existing archive, 'a' to append data to an existing
            file or 'w' to create a new file overwriting an existing one. `mode'
@@ -1607,15 +2553,48 @@ class TarFile(object):
             self.debug = debug
         if errorlevel is not None:
             self.errorlevel = errorlevel
+        if retain_members is not None:
+            self.retain_members = retain_members
+        if defer_metadata is not None:
+            self.defer_metadata = defer_metadata
+        if use_mmap is not None:
+            self.use_mmap = use_mmap
+        if digest is not None:
+            self.digest = digest
+
+        self._mapped = None     # the archive file, if self.fileobj is
+                                # a mapping of it (see use_mmap)
+        if self.use_mmap and self.mode == "r" and isinstance(fileobj, file):
+            try:
+                m = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                # e.g., empty file: read as usual
+                pass
+            else:
+                m.seek(fileobj.tell())
+                self._mapped = fileobj
+                self.fileobj = m
 
         # Init datastructures.
         self.closed = False
         self.members = []       # list of members as TarInfo objects
+        self._index = {}        # dictionary mapping member names to the
+                                # last member with that name
         self._loaded = False    # flag if all members have been read
         self.offset = self.fileobj.tell()
                                 # current position in the archive file
         self.inodes = {}        # dictionary caching the inodes of
                                 # archive members already added
+        self._owners = {}       # dictionary caching the uid/gid of
+                                # (uname, gname, uid, gid) for chown()
+        self.digests = {}       # member name -> hex digest of data
+                                # written (see digest)
+        self._deferred = []     # (tarinfo, targetpath) of directories
+                                # with deferred metadata
+        self._local = threading.local()
+                                # per thread reusable buffer for makefile()
+        self._readlock = threading.Lock()
+                                # serializes positioned reads of fileobj
 
         if self.mode == "r":
             self.firstmember = None
@@ -1671,18 +2650,29 @@ class TarFile(object):
            'r:'         open for reading exclusively uncompressed
            'r:gz'       open for reading with gzip compression
            'r:bz2'      open for reading with bzip2 compression
+           'r:xz'       open for reading with xz compression
+           'r:zst'      open for reading with zstd compression
            'a' or 'a:'  open for appending, creating the file if necessary
            'w' or 'w:'  open for writing without compression
            'w:gz'       open for writing with gzip compression
            'w:bz2'      open for writing with bzip2 compression
+           'w:xz'       open for writing with xz compression
+           'w:zst'      open for writing with zstd compression
 
            'r|*'        open a stream of tar blocks with transparent compression
            'r|'         open an uncompressed stream of tar blocks for reading
            'r|gz'       open a gzip compressed stream of tar blocks
            'r|bz2'      open a bzip2 compressed stream of tar blocks
+           'r|xz'       open an xz compressed stream of tar blocks
+           'r|zst'      open a zstd compressed stream of tar blocks
            'w|'         open an uncompressed stream for writing
            'w|gz'       open a gzip compressed stream for writing
            'w|bz2'      open a bzip2 compressed stream for writing
+           'w|xz'       open an xz compressed stream for writing
+           'w|zst'      open a zstd compressed stream for writing
+
+           xz and zstd require the lzma (or backports.lzma) and
+           zstandard modules, respectively.
         """
 
         if not name and not fileobj:
@@ -1723,9 +2713,12 @@ class TarFile(object):
             if filemode not in "rw":
                 raise ValueError("mode must be 'r' or 'w'")
 
-            t = cls(name, filemode,
-                    _Stream(name, filemode, comptype, fileobj, bufsize),
-                    **kwargs)
+            stream = _Stream(name, filemode, comptype, fileobj, bufsize)
+            try:
+                t = cls(name, filemode, stream, **kwargs)
+            except:
+                stream.close()
+                raise
             t._extfileobj = False
             return t
 
@@ -1745,9 +2738,12 @@ class TarFile(object):
     taropen = classmethod(taropen)
 
     #@classmethod
-    def gzopen(cls, name, mode="r", fileobj=None, compresslevel=9, **kwargs):
+    def gzopen(cls, name, mode="r", fileobj=None, compresslevel=9, jobs=None,
+               **kwargs):
         """Open gzip compressed tar archive name for reading or writing.
-           Appending is not allowed.
+           Appending is not allowed. If jobs is given when writing, the
+           data is written as independent members deflated by up to jobs
+           threads (see _GzipWriter).
         """
         if len(mode) > 1 or mode not in "rw":
             raise ValueError("mode must be 'r' or 'w'")
@@ -1758,9 +2754,42 @@ class TarFile(object):
         except (ImportError, AttributeError):
             raise CompressionError("gzip module is not available")
 
+        if mode == "w" and jobs is not None:
+            # Deflate independent members in threads (see _GzipWriter).
+            close_fileobj = fileobj is None
+            if fileobj is None:
+                fileobj = bltn_open(name, "wb")
+            t = cls.taropen(name, mode,
+                _GzipWriter(fileobj, compresslevel, jobs,
+                            close_fileobj=close_fileobj),
+                **kwargs)
+            t._extfileobj = False
+            return t
+
+        close_fileobj = fileobj is None
         if fileobj is None:
             fileobj = bltn_open(name, mode + "b")
 
+        if mode == "r":
+            # Inflate in other threads (see _GzipReader).
+            pos = fileobj.tell()
+            buf = fileobj.read(len(GZIP_MAGIC))
+            fileobj.seek(pos)
+            if buf != GZIP_MAGIC:
+                if close_fileobj:
+                    fileobj.close()
+                raise ReadError("not a gzip file")
+            gzfileobj = _GzipReader(fileobj, close_fileobj=close_fileobj)
+            try:
+                t = cls.taropen(name, mode, gzfileobj, **kwargs)
+            except:
+                gzfileobj.close()
+                if sys.exc_info()[0] in (IOError, CompressionError):
+                    raise ReadError("not a gzip file")
+                raise
+            t._extfileobj = False
+            return t
+
         try:
             t = cls.taropen(name, mode,
                 gzip.GzipFile(name, mode, compresslevel, fileobj),
@@ -1797,11 +2826,80 @@ class TarFile(object):
         return t
     bz2open = classmethod(bz2open)
 
+    #@classmethod
+    def _proxyopen(cls, name, mode, fileobj, comptype, magic, compresslevel,
+                   jobs=None, **kwargs):
+        """Open tar archive name, compressed with comptype (see
+           _CompressionProxy), for reading or writing. In read mode,
+           the data must start with magic (or one of a tuple of magics
+           of the same length).
+        """
+        if len(mode) > 1 or mode not in "rw":
+            raise ValueError("mode must be 'r' or 'w'")
+
+        # Fail early if the module is missing.
+        if comptype == "xz":
+            _get_lzma()
+        else:
+            _get_zstandard()
+
+        close_fileobj = fileobj is None
+        if fileobj is None:
+            fileobj = bltn_open(name, mode + "b")
+
+        if mode == "r":
+            pos = fileobj.tell()
+            if not isinstance(magic, tuple):
+                magic = (magic,)
+            buf = fileobj.read(len(magic[0]))
+            fileobj.seek(pos)
+            if buf not in magic:
+                if close_fileobj:
+                    fileobj.close()
+                raise ReadError("not a %s file" % comptype)
+
+        try:
+            t = cls.taropen(name, mode,
+                _CompressionProxy(fileobj, mode, comptype, compresslevel,
+                                  close_fileobj, jobs),
+                **kwargs)
+        except (IOError, EOFError):
+            if close_fileobj:
+                fileobj.close()
+            raise ReadError("not a %s file" % comptype)
+        t._extfileobj = False
+        return t
+    _proxyopen = classmethod(_proxyopen)
+
+    #@classmethod
+    def xzopen(cls, name, mode="r", fileobj=None, compresslevel=6, jobs=None,
+               **kwargs):
+        """Open xz compressed tar archive name for reading or writing.
+           Appending is not allowed. jobs is accepted for symmetry with
+           gzopen() but xz data is compressed by a single thread.
+        """
+        return cls._proxyopen(name, mode, fileobj, "xz", XZ_MAGIC,
+                              compresslevel, **kwargs)
+    xzopen = classmethod(xzopen)
+
+    #@classmethod
+    def zstopen(cls, name, mode="r", fileobj=None, compresslevel=3, jobs=None,
+                **kwargs):
+        """Open zstd compressed tar archive name for reading or writing.
+           Appending is not allowed. When writing, data is compressed by
+           jobs threads, if more than one.
+        """
+        return cls._proxyopen(name, mode, fileobj, "zst", ZSTD_MAGICS,
+                              compresslevel, jobs, **kwargs)
+    zstopen = classmethod(zstopen)
+
     # All *open() methods are registered here.
     OPEN_METH = {
         "tar": "taropen",   # uncompressed tar
         "gz":  "gzopen",    # gzip compressed tar
-        "bz2": "bz2open"    # bzip2 compressed tar
+        "bz2": "bz2open",   # bzip2 compressed tar
+        "xz":  "xzopen",    # xz compressed tar
+        "zst": "zstopen"    # zstd compressed tar
     }
 
     #--------------------------------------------------------------------------
@@ -1823,6 +2921,9 @@ class TarFile(object):
             if remainder > 0:
                 self.fileobj.write(NUL * (RECORDSIZE - remainder))
 
+        if self._mapped is not None:
+            self.fileobj.close()
+            self.fileobj = self._mapped
         if not self._extfileobj:
             self.fileobj.close()
         self.closed = True
@@ -1843,6 +2944,8 @@ class TarFile(object):
            list has the same order as the members in the archive.
         """
         self._check()
+        if not self.retain_members:
+            raise TarError("members are not retained")
         if not self._loaded:    # if we want to obtain a list of
             self._load()        # all members, we first have to
                                 # scan the whole archive.
@@ -1986,13 +3089,16 @@ class TarFile(object):
                     print "link to", tarinfo.linkname,
             print
 
-    def add(self, name, arcname=None, recursive=True, exclude=None):
+    def add(self, name, arcname=None, recursive=True, exclude=None, filter=None):
         """Add the file `name' to the archive. `name' may be any type of file
            (directory, fifo, symbolic link, etc.). If given, `arcname'
            specifies an alternative name for the file in the archive.
-           Directories are added recursively by default. This can be avoided by
-           setting `recursive' to False. `exclude' is a function that should
-           return True for each filename to be excluded.
+           Directories are added recursively by default, in sorted order.
+           This can be avoided by setting `recursive' to False. `exclude' is
+           a function that should return True for each filename to be
+           excluded. `filter' is a function that expects a TarInfo object
+           argument and returns the changed TarInfo object. If it instead
+           returns None the TarInfo object will be excluded from the archive.
         """
         self._check("aw")
 
@@ -2015,8 +3121,9 @@ class TarFile(object):
             if recursive:
                 if arcname == ".":
                     arcname = ""
-                for f in os.listdir(name):
-                    self.add(f, os.path.join(arcname, f), recursive, exclude)
+                for f in sorted(os.listdir(name)):
+                    self.add(f, os.path.join(arcname, f), recursive, exclude,
+                             filter)
             return
 
         self._dbg(1, name)
@@ -2028,6 +3135,13 @@ class TarFile(object):
             self._dbg(1, "tarfile: Unsupported type %r" % name)
             return
 
+        # Change or exclude the TarInfo object.
+        if filter is not None:
+            tarinfo = filter(tarinfo)
+            if tarinfo is None:
+                self._dbg(2, "tarfile: Excluded %r" % name)
+                return
+
         # Append the tar header and data to the archive.
         if tarinfo.isreg():
             f = bltn_open(name, "rb")
@@ -2037,8 +3151,9 @@ class TarFile(object):
         elif tarinfo.isdir():
             self.addfile(tarinfo)
             if recursive:
-                for f in os.listdir(name):
-                    self.add(os.path.join(name, f), os.path.join(arcname, f), recursive, exclude)
+                for f in sorted(os.listdir(name)):
+                    self.add(os.path.join(name, f), os.path.join(arcname, f),
+                             recursive, exclude, filter)
 
         else:
             self.addfile(tarinfo)
@@ -2068,6 +3183,7 @@ class TarFile(object):
             self.offset += blocks * BLOCKSIZE
 
         self.members.append(tarinfo)
+        self._index[tarinfo.name] = tarinfo
 
     def extractall(self, path=".", members=None):
         """Extract all members from the archive to the current working
@@ -2082,13 +3198,16 @@ class TarFile(object):
             members = self
 
         for tarinfo in members:
-            if tarinfo.isdir():
+            if tarinfo.isdir() and not self.defer_metadata:
                 # Extract directories with a safe mode.
                 directories.append(tarinfo)
                 tarinfo = copy.copy(tarinfo)
                 tarinfo.mode = 0700
             self.extract(tarinfo, path)
 
+        if self.defer_metadata:
+            self.apply_deferred_metadata()
+
         # Reverse sort directories.
         directories.sort(key=operator.attrgetter('name'))
         directories.reverse()
@@ -2106,6 +3225,145 @@ class TarFile(object):
                 else:
                     self._dbg(1, "tarfile: %s" % e)
 
+    def apply_deferred_metadata(self):
+        """Set owner, modification time and permissions on the directories
+           extracted since the last call, deepest first (see
+           defer_metadata).
+        """
+        deferred = self._deferred
+        self._deferred = []
+
+        # Reverse sort directories.
+        deferred.sort(key=operator.itemgetter(1))
+        deferred.reverse()
+
+        for tarinfo, dirpath in deferred:
+            try:
+                self.chown(tarinfo, dirpath)
+                self.utime(tarinfo, dirpath)
+                self.chmod(tarinfo, dirpath)
+            except EnvironmentError, e:
+                if self.errorlevel > 0:
+                    raise
+                else:
+                    self._dbg(1, "tarfile: %s %r" % (e.strerror, e.filename))
+            except ExtractError, e:
+                if self.errorlevel > 1:
+                    raise
+                else:
+                    self._dbg(1, "tarfile: %s" % e)
+
+    def parallelizable(self):
+        """Return whether members can be extracted concurrently by
+           extractmany(), i.e., the archive is an uncompressed file.
+        """
+        return self._rawfile() is not None
+
+    def _rawfile(self):
+        """Return the file of an uncompressed archive opened for reading,
+           or None.
+        """
+        if self._mapped is not None:
+            return self._mapped
+        if self.mode == "r" and isinstance(self.fileobj, file):
+            return self.fileobj
+        return None
+
+    def extractmany(self, members, path="", jobs=1):
+        """Extract the TarInfo objects in members (in archive order) to
+           path, as extract() does. If jobs > 1 and the archive is
+           parallelizable(), this is done in three passes: directories
+           (and missing parent directories), then regular files, by up
+           to jobs threads, each reading its member's data at its offset,
+           then all other members (links, devices, ...) in order. The
+           metadata of directories is deferred until the end (or until
+           apply_deferred_metadata() is called if defer_metadata is set).
+           Otherwise, members are extracted in order. Return a list of
+           (tarinfo, exception) for the members that failed.
+        """
+        failed = []
+        if jobs <= 1 or not self.parallelizable():
+            for tarinfo in members:
+                try:
+                    self.extract(tarinfo, path)
+                except Exception, e:
+                    failed.append((tarinfo, e))
+            return failed
+
+        defer_metadata = self.defer_metadata
+        self.defer_metadata = True
+        try:
+            dirs = []
+            files = []
+            others = []
+            for tarinfo in members:
+                if tarinfo.isdir():
+                    dirs.append(tarinfo)
+                elif tarinfo.isreg() and getattr(tarinfo, "sparse", None) is None:
+                    files.append(tarinfo)
+                else:
+                    others.append(tarinfo)
+
+            for tarinfo in dirs:
+                try:
+                    self.extract(tarinfo, path)
+                except Exception, e:
+                    failed.append((tarinfo, e))
+
+            # Create parent directories that are not part of the
+            # archive before the threads need them.
+            upperdirs = {}
+            for tarinfo in files:
+                upperdirs[os.path.dirname(os.path.join(path, tarinfo.name))] = None
+            for upperdir in sorted(upperdirs.keys()):
+                if upperdir and not os.path.exists(upperdir):
+                    try:
+                        os.makedirs(upperdir)
+                    except EnvironmentError, e:
+                        if e.errno != errno.EEXIST:
+                            raise
+
+            queue = Queue.Queue()
+            for i, tarinfo in enumerate(files):
+                queue.put((i, tarinfo))
+            errors = {}
+
+            def worker():
+                while True:
+                    try:
+                        i, tarinfo = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self.extract(tarinfo, path)
+                    except Exception, e:
+                        errors[i] = e
+
+            threads = []
+            for i in xrange(min(jobs, len(files))):
+                thread = threading.Thread(target=worker)
+                thread.setDaemon(True)
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                # Wake up now and then so that ^C gets through.
+                while thread.isAlive():
+                    thread.join(1)
+            for i in sorted(errors.keys()):
+                failed.append((files[i], errors[i]))
+
+            for tarinfo in others:
+                try:
+                    self.extract(tarinfo, path)
+                except Exception, e:
+                    failed.append((tarinfo, e))
+        finally:
+            self.defer_metadata = defer_metadata
+
+        if not defer_metadata:
+            self.apply_deferred_metadata()
+        return failed
+
     def extract(self, member, path=""):
         """Extract a member from the archive to the current working directory,
            using its full name. Its file information is extracted as accurately
@@ -2216,6 +3474,15 @@ class TarFile(object):
         else:
             self.makefile(tarinfo, targetpath)
 
+        if self.defer_metadata:
+            if tarinfo.isdir():
+                self._deferred.append((tarinfo, targetpath))
+                return
+            elif tarinfo.isreg() or tarinfo.type not in SUPPORTED_TYPES:
+                # Owner and mode were set by makefile().
+                self.utime(tarinfo, targetpath)
+                return
+
         self.chown(tarinfo, targetpath)
         if not tarinfo.issym():
             self.chmod(tarinfo, targetpath)
@@ -2238,13 +3505,44 @@ class TarFile(object):
                 raise
 
     def makefile(self, tarinfo, targetpath):
-        """Make a file called targetpath.
-        """
-        source = self.extractfile(tarinfo)
+        """Make a file called targetpath. The data of a (non-sparse)
+           member of an uncompressed archive file is copied directly from
+           the archive file, in the kernel if possible (see copyfd()), or
+           from its mapping (see use_mmap). The data is hashed on the way
+           if self.digest is set.
+        """
+        digest = self.digest and self.digest()
+        rawfile = self._rawfile()
+        if rawfile is not None and getattr(tarinfo, "sparse", None) is None:
+            source = None
+        else:
+            source = self.extractfile(tarinfo)
         target = bltn_open(targetpath, "wb")
-        copyfileobj(source, target)
-        source.close()
-        target.close()
+        try:
+            if source is not None:
+                copyfileobj(source, target, tarinfo.size, digest)
+            elif digest is None and copyfd(rawfile.fileno(),
+                    tarinfo.offset_data, target.fileno(), tarinfo.size):
+                pass
+            elif self._mapped is not None:
+                copymap(self.fileobj, tarinfo.offset_data, target,
+                        tarinfo.size, digest)
+            else:
+                buf = getattr(self._local, "copybuf", None)
+                if buf is None:
+                    buf = self._local.copybuf = bytearray(COPY_BUFSIZE)
+                copyrange(self.fileobj, tarinfo.offset_data, target,
+                          tarinfo.size, buf, self._readlock, digest)
+            if digest is not None:
+                self.digests[tarinfo.name] = digest.hexdigest()
+            if self.defer_metadata:
+                # Use the open file rather than the path.
+                self.chown(tarinfo, targetpath, target.fileno())
+                self.chmod(tarinfo, targetpath, target.fileno())
+        finally:
+            if source is not None:
+                source.close()
+            target.close()
 
     def makeunknown(self, tarinfo, targetpath):
         """Make a file from a TarInfo object with an unknown type
@@ -2297,18 +3595,28 @@ class TarFile(object):
 
             try:
                 self._extract_member(self.getmember(linkpath), targetpath)
-            except (EnvironmentError, KeyError), e:
+            except (EnvironmentError, KeyError, TarError), e:
+                # Copy what the link would point to: a symlink is
+                # relative to its directory, a hard link to the
+                # extraction path (see extract()), not to the cwd.
+                if tarinfo.issym():
+                    linkpath = os.path.join(os.path.dirname(targetpath),
+                                            tarinfo.linkname)
+                else:
+                    linkpath = tarinfo._link_target
                 linkpath = os.path.normpath(linkpath)
                 try:
                     shutil.copy2(linkpath, targetpath)
                 except EnvironmentError, e:
                     raise IOError("link could not be created")
 
-    def chown(self, tarinfo, targetpath):
-        """Set owner of targetpath according to tarinfo.
+    def _getowner(self, tarinfo):
+        """Return the (uid, gid) to give to the extracted tarinfo. Lookups
+           are cached, as they may be costly (e.g., NIS, LDAP).
         """
-        if pwd and hasattr(os, "geteuid") and os.geteuid() == 0:
-            # We have to be root to do so.
+        key = (tarinfo.uname, tarinfo.gname, tarinfo.uid, tarinfo.gid)
+        owner = self._owners.get(key)
+        if owner is None:
             try:
                 g = grp.getgrnam(tarinfo.gname)[2]
             except KeyError:
@@ -2323,8 +3631,20 @@ class TarFile(object):
                     u = pwd.getpwuid(tarinfo.uid)[2]
                 except KeyError:
                     u = os.getuid()
+            owner = self._owners[key] = (u, g)
+        return owner
+
+    def chown(self, tarinfo, targetpath, fd=None):
+        """Set owner of targetpath according to tarinfo. If fd is given,
+           it is the open file descriptor of targetpath.
+        """
+        if pwd and hasattr(os, "geteuid") and os.geteuid() == 0:
+            # We have to be root to do so.
+            u, g = self._getowner(tarinfo)
             try:
-                if tarinfo.issym() and hasattr(os, "lchown"):
+                if fd is not None and hasattr(os, "fchown"):
+                    os.fchown(fd, u, g)
+                elif tarinfo.issym() and hasattr(os, "lchown"):
                     os.lchown(targetpath, u, g)
                 else:
                     if sys.platform != "os2emx":
@@ -2332,10 +3652,16 @@ class TarFile(object):
             except EnvironmentError, e:
                 raise ExtractError("could not change owner")
 
-    def chmod(self, tarinfo, targetpath):
-        """Set file permissions of targetpath according to tarinfo.
+    def chmod(self, tarinfo, targetpath, fd=None):
+        """Set file permissions of targetpath according to tarinfo. If fd
+           is given, it is the open file descriptor of targetpath.
         """
-        if hasattr(os, 'chmod'):
+        if fd is not None and hasattr(os, 'fchmod'):
+            try:
+                os.fchmod(fd, tarinfo.mode)
+            except EnvironmentError, e:
+                raise ExtractError("could not change mode")
+        elif hasattr(os, 'chmod'):
             try:
                 os.chmod(targetpath, tarinfo.mode)
             except EnvironmentError, e:
@@ -2374,7 +3700,9 @@ class TarFile(object):
                 tarinfo = self.tarinfo.fromtarfile(self)
                 if tarinfo is None:
                     return
-                self.members.append(tarinfo)
+                if self.retain_members:
+                    self.members.append(tarinfo)
+                    self._index[tarinfo.name] = tarinfo
 
             except HeaderError, e:
                 if self.ignore_zeros:
@@ -2399,6 +3727,13 @@ class TarFile(object):
         # Ensure that all members have been loaded.
         members = self.getmembers()
 
+        # The index holds the last member of each name: use it unless
+        # that member does not come before tarinfo.
+        member = self._index.get(name)
+        if member is not None and (tarinfo is None or
+                member.offset < tarinfo.offset):
+            return member
+
         if tarinfo is None:
             end = len(members)
         else:
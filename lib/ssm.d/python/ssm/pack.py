@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssm/pack.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides pack_package() to build .ssm files.
+
+Packages are canonical: members are added in sorted order with
+owner and group normalized to 0 (no names), so packing the same
+directory twice gives the same archive. gzip packages are written as
+independent members (see ext_tarfile._GzipWriter) deflated by
+several threads, which ext_tarfile also inflates concurrently; zstd
+packages are compressed by several threads of the zstandard module.
+"""
+
+# system imports
+import os
+import os.path
+
+#
+from ssm import ext_tarfile as tarfile
+from ssm import utils
+
+# compression type: (open mode, default level)
+COMPRESSIONS = {
+    "gz": ("w:gz", 6),
+    "xz": ("w:xz", 6),
+    "zst": ("w:zst", 3),
+    "tar": ("w", None),
+}
+
+def normalize_tarinfo(tarinfo):
+    """Clear the owner and group of tarinfo.
+    """
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    return tarinfo
+
+def pack_package(path, out_path, comptype="gz", compresslevel=None, jobs=1):
+    """Write the package directory at path to the .ssm file out_path
+    (replaced atomically). Return (package_name, filename, size,
+    mtime, md5, member_count) for the new file; the first five are
+    the fields of its repository index entry.
+    """
+    path = os.path.normpath(path)
+    package_name = os.path.basename(path)
+    if not os.path.isdir(path):
+        raise utils.SSMExitException("error: cannot find package directory (%s)" % path)
+    if not os.path.isfile(os.path.join(path, ".ssm.d", "control")):
+        utils.print_warning("warning: package has no control file (%s)" % package_name)
+    if comptype not in COMPRESSIONS:
+        raise utils.SSMExitException("error: unknown compression type (%s)" % comptype)
+
+    mode, default_level = COMPRESSIONS[comptype]
+    kwargs = {}
+    if comptype != "tar":
+        if compresslevel == None:
+            compresslevel = default_level
+        kwargs = {"compresslevel": compresslevel, "jobs": jobs}
+
+    counts = [0]
+    def filter(tarinfo):
+        counts[0] += 1
+        return normalize_tarinfo(tarinfo)
+
+    tmp_path = "%s.tmp.%s" % (out_path, os.getpid())
+    try:
+        tarf = tarfile.open(tmp_path, mode, **kwargs)
+        try:
+            tarf.add(path, package_name, filter=filter)
+        finally:
+            tarf.close()
+        os.rename(tmp_path, out_path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    st = os.stat(out_path)
+    return (package_name, os.path.basename(out_path), st.st_size,
+        int(st.st_mtime), utils.checksum(out_path), counts[0])
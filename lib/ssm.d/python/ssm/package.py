@@ -23,9 +23,26 @@
 # GPL--end
 
 """Provides the Package class.
+
+An installed package holds a manifest (.ssm.d/manifest, see
+MANIFEST_NAME) of the members extracted from its .ssm file, written
+by install. Each non-comment line holds tab-separated fields:
+
+<path> <type> <size> <mode> <linkname> <md5>
+
+where path is relative to the package directory ("." for the
+directory itself), type is one of f (file), d (directory), l
+(symlink), h (hardlink, linkname is then relative to the package
+directory), p (fifo), c or b (devices), size and md5 are those of the
+data of files (md5 is computed while the file is written, unless
+installed without checksums), and mode is in octal. Paths and
+linknames are escaped (string_escape) so that they hold no tabs or
+newlines; empty fields do not apply. The first line identifies the
+manifest format version.
 """
 
 # system imports
+import errno
 import os
 import os.path
 import re
@@ -37,6 +54,40 @@ import traceback
 from ssm import globls
 from ssm import utils
 
+MANIFEST_NAME = "manifest"
+MANIFEST_VERSION = 1
+MANIFEST_HEADER = "# ssm manifest version %s" % MANIFEST_VERSION
+
+def format_manifest(entries):
+    """Return manifest file contents for list of (path, type, size,
+    mode, linkname, md5) entries.
+    """
+    lines = [MANIFEST_HEADER]
+    for path, type, size, mode, linkname, checksum in sorted(entries):
+        lines.append("%s\t%s\t%s\t%04o\t%s\t%s" % (path.encode("string_escape"),
+            type, size, mode, linkname.encode("string_escape"), checksum))
+    return "\n".join(lines)+"\n"
+
+def parse_manifest(s):
+    """Return list of (path, type, size, mode, linkname, md5) entries
+    from manifest file contents, or None if the contents are not a
+    supported manifest.
+    """
+    lines = s.split("\n")
+    if lines[0].strip() != MANIFEST_HEADER:
+        return None
+    entries = []
+    for line in lines[1:]:
+        if line.startswith("#") or line.strip() == "":
+            continue
+        t = line.split("\t")
+        if len(t) < 6:
+            return None
+        path, type, size, mode, linkname, checksum = t[:6]
+        entries.append((path.decode("string_escape"), type, int(size),
+            int(mode, 8), linkname.decode("string_escape"), checksum))
+    return entries
+
 def special_links_walk(root):
     """Alternate to os.walk() which provide special support for
     handling symlinks with linknames starting with "./" and ending
@@ -69,6 +120,25 @@ def special_links_walk(root):
         for root2, dirnames2, filenames2 in special_links_walk(path):
             yield root2, dirnames2, filenames2
 
+def manifest_type(tarinfo):
+    """Return manifest type of member tarinfo.
+    """
+    if tarinfo.isreg():
+        return "f"
+    elif tarinfo.isdir():
+        return "d"
+    elif tarinfo.issym():
+        return "l"
+    elif tarinfo.islnk():
+        return "h"
+    elif tarinfo.isfifo():
+        return "p"
+    elif tarinfo.ischr():
+        return "c"
+    elif tarinfo.isblk():
+        return "b"
+    return "f"
+
 class Package:
     """Manager for a package (existent or not, although the domain
     must exist).
@@ -81,6 +151,7 @@ class Package:
         self.short_name, self.version, self.platform = self.name.split("_", 2)
         self.exclude_path = os.path.join(self.path, ".ssm.d/exclude")
         self.include_path = os.path.join(self.path, ".ssm.d/include")
+        self.manifest_path = os.path.join(self.path, ".ssm.d", MANIFEST_NAME)
 
     # state
     def exists(self):
@@ -92,6 +163,13 @@ class Package:
             m = utils.read_control_map(self.path+"/.ssm.d/control")
         return m
 
+    def get_manifest(self):
+        """Return list of manifest entries (see parse_manifest())
+        recorded at install, or None if there is no (usable)
+        manifest.
+        """
+        return parse_manifest(utils.loads(self.manifest_path))
+
     def get_exclude_cre(self):
         # default to exclude none
         return re.compile(utils.loads(self.include_path) or "(?!.*)")
@@ -137,8 +215,8 @@ class Package:
         return short_name == self.short_name and platform == self.platform
         
     # operations
-    def execute_script(self, step, pub_domain=None):
-        """Execute script for step.
+    def execute_script(self, step, pub_domain=None, cwd=None):
+        """Execute script for step, in directory cwd if given.
         """
         path = self.path+"/.ssm.d/"+step
         if not os.path.isfile(path):
@@ -174,10 +252,12 @@ class Package:
 
             try:
                 if popen_type == "subprocess":
-                    p = Popen(cmd, bufsize=10000000)
+                    p = Popen(cmd, bufsize=10000000, cwd=cwd)
                     p.wait()
                     returncode = p.returncode
                 else:
+                    if cwd:
+                        utils.chdir(cwd)
                     p = Popen(cmd, bufsize=10000000)
                     status = p.wait()
                     if os.WIFEXITED(status):
@@ -191,54 +271,196 @@ class Package:
                 raise Exception("error: execute script failed")
         return
 
-    def install(self, tarf, username, groupname, clobber, force=False):
-        """Install package from file.
+    def install(self, tarf, username, groupname, clobber, force=False, register=True, jobs=1, checksums=True):
+        """Install package from file. If register is not set, the
+        package is not recorded as installed in the domain; the
+        caller must then call register_installed().
+
+        A new package is extracted into a hidden staging directory
+        in the domain (see get_staging_path()) and renamed into place
+        once complete, so that a failed install does not leave a
+        partial package tree behind. An existing package (clobber or
+        force) is updated in place. The post-install script is run
+        once the package is in place (it is given the package path).
+
+        Members are extracted relative to a base path (no chdir),
+        so that packages may be installed concurrently. If jobs > 1
+        and the archive allows it (uncompressed file), the files of
+        the package are written by jobs threads (see
+        TarFile.extractmany()).
+
+        The extracted members are recorded in the package manifest;
+        entries of an existing package that are not extracted again
+        are kept. With checksums (the default), the md5 of each file is
+        computed as it is written (see TarFile.digest); without, its
+        md5 field is left empty, and file data may be copied in the
+        kernel instead (see ext_tarfile.copyfd()).
         """
         if self.domain.is_frozen():
             raise utils.SSMExitException("error: domain is frozen")
 
         force = force or globls.force
-        cwd = os.getcwd()
 
-        if self.exists() and not (force or clobber):
-            raise utils.SSMExitException("error: package already installed")
+        if self.exists():
+            if not (force or clobber):
+                raise utils.SSMExitException("error: package already installed")
+            staging_path = None
+            base_path = self.domain.path
+        else:
+            staging_path = self.get_staging_path()
+            base_path = staging_path
 
         try:
-            utils.chdir(self.domain.path)
-            for member in tarf.getmembers():
+            if staging_path:
+                utils.mkdir(staging_path, 0700)
+
+            # set owner/mode of files through the open file and those
+            # of directories once all members are extracted
+            tarf.defer_metadata = True
+            if checksums:
+                tarf.digest = utils.md5
+            manifest = {}
+            if not staging_path:
+                for entry in self.get_manifest() or []:
+                    manifest[entry[0]] = entry
+
+            def add_manifest_entry(member):
+                path = os.path.normpath(member.name)[len(self.name)+1:] or "."
+                linkname = member.linkname
+                if member.islnk():
+                    linkname = os.path.normpath(linkname)[len(self.name)+1:]
+                manifest[path] = (path, manifest_type(member),
+                    member.isreg() and member.size or 0, member.mode & 07777,
+                    linkname, tarf.digests.pop(member.name, ""))
+
+            def extract_failed(path, e):
+                if isinstance(e, EnvironmentError) and e.errno in (errno.ENOSPC, errno.EDQUOT):
+                    # no point going on
+                    raise e
+                utils.print_error("error: could not extract file (%s)" % path)
+
+            # iterate lazily (not getmembers()): each member is
+            # extracted as it is read, so the archive is read (and
+            # decompressed) once and members are not accumulated;
+            # unless extracting concurrently, after the scan
+            parallel = jobs > 1 and tarf.parallelizable()
+            selected = []
+            for member in tarf:
                 try:
                     path = os.path.normpath(member.name)
                     if path.startswith(self.name):
-                        if os.path.exists(path):
-                            if not clobber:
-                                utils.print_warning("warning: clobbering not enabled (%s)" % path)
-                                continue
-                            elif os.path.isdir(path):
-                                utils.print_warning("warning: cannot clobber directory (%s)" % path)
-                                continue
-                            elif os.path.isfile(path):
-                                utils.print_warning("warning: clobbering file (%s)" % path)
-                                utils.remove(path)
-                        member.uname = username
-                        member.gname = groupname
+                        if not staging_path:
+                            target_path = os.path.join(base_path, path)
+                            if os.path.exists(target_path):
+                                if not clobber:
+                                    utils.print_warning("warning: clobbering not enabled (%s)" % path)
+                                    continue
+                                elif os.path.isdir(target_path):
+                                    utils.print_warning("warning: cannot clobber directory (%s)" % path)
+                                    continue
+                                elif os.path.isfile(target_path):
+                                    utils.print_warning("warning: clobbering file (%s)" % path)
+                                    utils.remove(target_path)
+                        if username != None:
+                            member.uname = username
+                        if groupname != None:
+                            member.gname = groupname
+                        if parallel:
+                            selected.append(member)
+                            continue
                         utils.print_verbose("extracting member (%s)" % member.name)
-                        tarf.extract(member)
+                        tarf.extract(member, base_path)
+                        add_manifest_entry(member)
                     elif path != ".":
                         utils.print_warning("warning: rejecting member not part of package (%s)" % path)
-                except:
+                except Exception, e:
                     if globls.debug:
                         traceback.print_exc()
-                    utils.print_error("error: could not extract file (%s)" % path)
+                    extract_failed(path, e)
 
-            self.execute_script("post-install")
-            self.domain.add_installed(self.path)
-            self.domain.remove_broken(self.path)
+            if selected:
+                utils.print_verbose("extracting %s members (%s jobs)" % (len(selected), jobs))
+                failed = set()
+                for member, e in tarf.extractmany(selected, base_path, jobs):
+                    # raised in a worker thread: no traceback to print
+                    utils.print_verbose("%s: %s" % (member.name, e))
+                    extract_failed(os.path.normpath(member.name), e)
+                    failed.add(member.name)
+                for member in selected:
+                    if member.name not in failed:
+                        add_manifest_entry(member)
+
+            # while directories are still writable (before their
+            # deferred modes are set)
+            manifest_path = os.path.join(base_path, self.name, ".ssm.d", MANIFEST_NAME)
+            if not os.path.isdir(os.path.dirname(manifest_path)):
+                utils.makedirs(os.path.dirname(manifest_path))
+            utils.dumps_atomic(format_manifest(manifest.values()), manifest_path)
+            tarf.apply_deferred_metadata()
+
+            if staging_path:
+                utils.rename(os.path.join(staging_path, self.name), self.path)
+                utils.rmdir(staging_path)
+                staging_path = None
+
+            self.execute_script("post-install", cwd=self.domain.path)
+            if register:
+                self.register_installed()
+        except:
+            if globls.debug:
+                traceback.print_exc()
+            if staging_path:
+                try:
+                    utils.rmtree(staging_path)
+                except:
+                    utils.print_warning("warning: could not remove staging directory (%s)" % staging_path)
+            raise utils.SSMExitException("error: could not install")
+
+    def get_staging_path(self):
+        """Return path of the (hidden) directory in which the package
+        is extracted before being renamed into place. It is in the
+        domain so that the rename does not cross filesystems.
+        """
+        return os.path.join(self.domain.path, ".ssm-staging.%s.%s" % (self.name, os.getpid()))
+
+    def clone(self, src_package, mode="copy", register=True):
+        """Install package by cloning the installed tree of the same
+        package in another domain (see utils.clonetree() for mode).
+        The post-install script is not run again: the tree is an
+        exact copy of the installed source, and files hardlinked
+        with the source must not be modified.
+
+        As for install(), the tree is cloned in the staging directory
+        and renamed into place, so that a failed clone leaves no
+        partial package.
+        """
+        if self.domain.is_frozen():
+            raise utils.SSMExitException("error: domain is frozen")
+        if self.exists():
+            raise utils.SSMExitException("error: package already installed")
+
+        staging_path = self.get_staging_path()
+        try:
+            utils.clonetree(src_package.path, staging_path, mode)
+            utils.rename(staging_path, self.path)
+            staging_path = None
+            if register:
+                self.register_installed()
         except:
             if globls.debug:
                 traceback.print_exc()
+            if staging_path and os.path.lexists(staging_path):
+                try:
+                    utils.rmtree(staging_path)
+                except:
+                    utils.print_warning("warning: could not remove staging directory (%s)" % staging_path)
             raise utils.SSMExitException("error: could not install")
 
-        utils.chdir(cwd)
+    def register_installed(self):
+        """Record package as installed in domain.
+        """
+        self.domain.add_installed(self.path)
+        self.domain.remove_broken(self.path)
 
     def uninstall(self):
         """Uninstall/remove package.
@@ -23,19 +23,84 @@
 # GPL--end
 
 """Provides the Repository class.
+
+A repository component (a directory of .ssm files) may provide an
+index file (see INDEX_NAME) which is used instead of a directory
+listing when loading urls. Each non-comment line of the index holds
+tab-separated fields:
+
+<package_name> <relative_url> <size> <mtime> <md5>
+
+The first line identifies the index format version. The index is
+generated/refreshed by 'ssm indexr', or updated by 'ssm pack --index'
+as packages are built.
 """
 
 # system imports
 import os.path
 import re
+import shutil
+import tempfile
 import traceback
 import urllib
 import urlparse
 
 #
+from ssm import cache
 from ssm import ext_tarfile as tarfile
 from ssm import utils
 
+INDEX_NAME = "ssm.index"
+INDEX_VERSION = 1
+INDEX_HEADER = "# ssm repository index version %s" % INDEX_VERSION
+
+def format_index(entries):
+    """Return index file contents for list of (package_name,
+    relative_url, size, mtime, md5) entries.
+    """
+    lines = [INDEX_HEADER]
+    for entry in sorted(entries):
+        lines.append("%s\t%s\t%s\t%s\t%s" % entry)
+    return "\n".join(lines)+"\n"
+
+def parse_index(s):
+    """Return list of (package_name, relative_url, size, mtime, md5)
+    entries from index file contents, or None if the contents are
+    not a supported index.
+    """
+    lines = s.split("\n")
+    if lines[0].strip() != INDEX_HEADER:
+        return None
+    entries = []
+    for line in lines[1:]:
+        if line.startswith("#") or line.strip() == "":
+            continue
+        t = line.split("\t")
+        if len(t) < 5:
+            return None
+        package_name, rel_url, size, mtime, checksum = t[:5]
+        entries.append((package_name, rel_url, int(size), int(mtime), checksum))
+    return entries
+
+def update_index(base_path, entries):
+    """Add (package_name, relative_url, size, mtime, md5) entries to
+    the index of the filesystem repository component at base_path,
+    replacing any for the same relative urls. The index is updated
+    under a lock so that packages may be added by several processes
+    at once.
+    """
+    index_path = os.path.join(base_path, INDEX_NAME)
+    lockf = utils.lock(index_path+".lock")
+    try:
+        entry_map = {}
+        for entry in parse_index(utils.loads(index_path)) or []:
+            entry_map[entry[1]] = entry
+        for entry in entries:
+            entry_map[entry[1]] = entry
+        utils.dumps_atomic(format_index(entry_map.values()), index_path)
+    finally:
+        utils.unlock(lockf)
+
 class Repository:
     """Accessor for SSM repository (file, ftp, http).
     """
@@ -49,36 +114,247 @@ class Repository:
         else:
             self.components = [""]
         self.loaded_urls = None
+        self.loaded_url_map = None
+        self.loaded_info = None
+        self.cache = cache.get_cache()
 
-    def get(self, package_name):
-        """Download package and return TarFile object.
+    def _fetch(self, url):
+        """Return (path, is_temporary) for a local copy of the package
+        at url. Remote packages are taken from/added to the cache, if
+        enabled. A package of a filesystem repository is used in place.
         """
-        tarf = None
-        url = self.find(package_name)
-        if url:
+        if self.is_local() and not url.startswith("file:"):
+            return url, False
+        if self.is_local() or self.cache == None:
+            path, headers = urllib.urlretrieve(url)
+            return path, not self.is_local()
+
+        f = None
+        info = self.get_info(url)
+        if info:
+            size, mtime, checksum = info
+        else:
+            # identify package by response headers
+            f = self._urlopen(url)
+            headers = f.info()
+            size = headers.getheader("content-length")
+            mtime = headers.getheader("last-modified")
+            checksum = None
+
+        key = cache.make_key(url, size, mtime, checksum)
+        path = key and self.cache.lookup(key)
+        if path:
+            if f:
+                f.close()
+            return path, False
+        if f == None:
+            f = self._urlopen(url)
+        # expected size, to detect truncated transfers (as
+        # urlretrieve() does)
+        if size == None:
+            size = f.info().getheader("content-length")
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            size = None
+        if key == None:
+            # not cacheable: download from the response already open,
+            # rather than fetching the package a second time
             try:
-                path, headers = urllib.urlretrieve(url)
-                tarf = tarfile.open(path)
-                tarf.errorlevel = 1 # exception on fatal errors
-                if url.startswith("http://") or url.startswith("ftp://"):
-                    # delete temp file
+                fd, path = tempfile.mkstemp(suffix=".ssm")
+                try:
+                    tmpf = os.fdopen(fd, "wb")
+                    try:
+                        shutil.copyfileobj(f, tmpf, 1024*1024)
+                        count = tmpf.tell()
+                    finally:
+                        tmpf.close()
+                    if size != None and count != size:
+                        raise utils.SSMException("error: size mismatch for package (%s): got %s of %s bytes" % (url, count, size))
+                except:
                     utils.remove(path)
-            except:
-                #traceback.print_exc()
-                tarf = None
+                    raise
+            finally:
+                f.close()
+            return path, True
+
+        try:
+            path = self.cache.add(key, f, checksum, size)
+        finally:
+            f.close()
+        return path, False
+
+    def _open(self, url, use_mmap=False):
+        """Download package at url and return TarFile object. The
+        members are compact (see CompactTarInfo) and not retained (see
+        TarFile.retain_members): the package is meant to be read once,
+        in order. If use_mmap is set, an uncompressed package is read
+        through a memory mapping of the local file (see
+        TarFile.use_mmap).
+        """
+        tarf = None
+        try:
+            path, is_temporary = self._fetch(url)
+            tarf = tarfile.open(path, tarinfo=tarfile.CompactTarInfo,
+                retain_members=False, use_mmap=use_mmap)
+            tarf.errorlevel = 1 # exception on fatal errors
+            if is_temporary:
+                # delete temp file
+                utils.remove(path)
+        except:
+            #traceback.print_exc()
+            tarf = None
+        return tarf
+
+    def _open_stream(self, url):
+        """Open package at url as a stream of tar blocks and return
+        TarFile object. Members must be processed in order, as they
+        arrive; nothing is written to a temporary file. A cached copy
+        is used, if available, but a package streamed from a remote
+        repository is not added to the cache.
+        """
+        tarf = None
+        try:
+            fileobj = None
+            if self.cache and not self.is_local():
+                info = self.get_info(url)
+                key = info and cache.make_key(url, *info)
+                path = key and self.cache.lookup(key)
+                if path:
+                    fileobj = open(path, "rb")
+            if fileobj == None:
+                if self.is_local():
+                    fileobj = open(url, "rb")
+                else:
+                    fileobj = self._urlopen(url)
+            tarf = tarfile.open(mode="r|*", fileobj=fileobj,
+                tarinfo=tarfile.CompactTarInfo, retain_members=False)
+            tarf.errorlevel = 1 # exception on fatal errors
+        except:
+            #traceback.print_exc()
+            tarf = None
         return tarf
 
+    def get(self, package_name, stream=False, use_mmap=False):
+        """Download package and return TarFile object. If stream is
+        set, the package is not downloaded beforehand but read while
+        it is being installed (see _open_stream()). Otherwise, if
+        use_mmap is set, an uncompressed package is memory mapped (see
+        _open()).
+        """
+        url = self.find(package_name)
+        if url:
+            if stream:
+                return self._open_stream(url)
+            return self._open(url, use_mmap)
+        return None
+
+    def get_many(self, package_names):
+        """Generate (package_name, TarFile object) for each package
+        name, downloading one package at a time. The TarFile object
+        is None if the package cannot be found or opened.
+        """
+        url_map = self.find_many(package_names)
+        for package_name in package_names:
+            url = url_map[package_name]
+            if url:
+                yield package_name, self._open(url)
+            else:
+                yield package_name, None
+
     def list(self):
         self.load_urls()
         return self.loaded_urls
 
     def find(self, package_name):
         self.load_urls()
-        filename = package_name+".ssm"
-        for url in self.loaded_urls:
-            if filename == os.path.basename(url):
-                return url
-        return None
+        return self.loaded_url_map.get(package_name)
+
+    def find_many(self, package_names):
+        """Return map of package name to url (None if not found).
+        """
+        self.load_urls()
+        url_map = {}
+        for package_name in package_names:
+            url_map[package_name] = self.loaded_url_map.get(package_name)
+        return url_map
+
+    def get_info(self, url):
+        """Return (size, mtime, md5) for url as recorded in the
+        repository index, or None if not indexed.
+        """
+        self.load_urls()
+        return self.loaded_info.get(url)
+
+    def is_local(self):
+        return not (self.url.startswith("http://") or self.url.startswith("ftp://"))
+
+    def build_index(self):
+        """Generate/refresh the index of each component of a
+        filesystem repository. Checksums of packages unchanged (size
+        and mtime) since the last index are reused. Return the number
+        of packages indexed.
+        """
+        if not self.is_local():
+            raise utils.SSMExitException("error: can only index filesystem repository")
+
+        count = 0
+        for comp in self.components:
+            base_url = os.path.join(self.url, comp)
+            index_path = os.path.join(base_url, INDEX_NAME)
+            old_entries = parse_index(utils.loads(index_path)) or []
+            old_map = dict([(entry[1], entry) for entry in old_entries])
+
+            entries = []
+            for url in self._load_file_urls(base_url):
+                filename = os.path.basename(url)
+                if not filename.endswith(".ssm"):
+                    continue
+                st = os.stat(url)
+                size, mtime = st.st_size, int(st.st_mtime)
+                old_entry = old_map.get(filename)
+                if old_entry and old_entry[2:4] == (size, mtime):
+                    checksum = old_entry[4]
+                else:
+                    utils.print_verbose("computing checksum (%s)" % url)
+                    checksum = utils.checksum(url)
+                entries.append((filename[:-4], filename, size, mtime, checksum))
+            utils.print_verbose("writing index (%s) with %s packages" % (index_path, len(entries)))
+            utils.dumps_atomic(format_index(entries), index_path)
+            count += len(entries)
+        return count
+
+    def _urlopen(self, url):
+        f = urllib.urlopen(url)
+        if f.getcode() not in [None, 200]:
+            f.close()
+            raise IOError("cannot open url (%s)" % url)
+        return f
+
+    def _load_index(self, base_url):
+        """Load urls and info from the component index. Return None if
+        there is no (usable) index.
+        """
+        index_url = os.path.join(base_url, INDEX_NAME)
+        try:
+            if self.is_local():
+                if not os.path.isfile(index_url):
+                    return None
+                s = open(index_url).read()
+            else:
+                s = self._urlopen(index_url).read()
+            entries = parse_index(s)
+        except:
+            #traceback.print_exc()
+            entries = None
+        if entries == None:
+            return None
+
+        utils.print_verbose("loaded index (%s)" % (index_url,))
+        info = {}
+        for package_name, rel_url, size, mtime, checksum in entries:
+            info[os.path.join(base_url, rel_url)] = (size, mtime, checksum)
+        return info
 
     def _load_ftp_urls(self, base_url):
         utils.print_verbose("loading urls over ftp (%s)" % (base_url,))
@@ -120,6 +396,9 @@ class Repository:
         if self.loaded_urls != None:
             return
 
+        urls = []
+        info = {}
+
         if self.url.startswith("http://"):
             _load_urls = self._load_http_urls
         elif self.url.startswith("ftp://"):
@@ -127,7 +406,21 @@ class Repository:
         else:
             _load_urls = self._load_file_urls
 
-        urls = []
         for comp in self.components:
-            urls.extend(_load_urls(os.path.join(self.url, comp)))
+            base_url = os.path.join(self.url, comp)
+            comp_info = self._load_index(base_url)
+            if comp_info != None:
+                urls.extend(sorted(comp_info.keys()))
+                info.update(comp_info)
+            else:
+                urls.extend(_load_urls(base_url))
+        # package name to url, first found wins
+        url_map = {}
+        for url in urls:
+            filename = os.path.basename(url)
+            if filename.endswith(".ssm"):
+                url_map.setdefault(filename[:-4], url)
+
         self.loaded_urls = urls
+        self.loaded_url_map = url_map
+        self.loaded_info = info
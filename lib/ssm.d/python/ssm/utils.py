@@ -27,27 +27,98 @@ packages except for ssm.globls.
 """
 
 # system imports
+import errno
+import fcntl
 import grp
 import os
 import os.path
 import pwd
+import Queue
 import shutil
 import sys
+import threading
 import time
 import traceback
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
 #
 from ssm import globls
 
+# serializes output of concurrent operations
+_print_lock = threading.Lock()
+
+# linux ioctl to clone (reflink) a file
+FICLONE = 0x40049409
+
+# linux renameat2() arguments
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
 class SSMException(Exception):
     pass
 
 class SSMExitException(SSMException):
     pass
 
+def checksum(path, blocksize=1024*1024):
+    """Return md5 hex digest of file contents.
+    """
+    m = md5()
+    f = open(path, "rb")
+    try:
+        while True:
+            buf = f.read(blocksize)
+            if not buf:
+                break
+            m.update(buf)
+    finally:
+        f.close()
+    return m.hexdigest()
+
 def dumps(s, path):
     open(path, "w+").write(s)
 
+def dumps_atomic(s, path):
+    """Write to temporary file and rename over path so that readers
+    never see a partially written file.
+    """
+    tmp_path = "%s.tmp.%s" % (path, os.getpid())
+    try:
+        f = open(tmp_path, "w")
+        f.write(s)
+        f.close()
+        os.rename(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def exchange(path1, path2):
+    """Atomically exchange path1 and path2 (both must exist), using
+    renameat2(). Return False if not supported (by the C library,
+    kernel or filesystem).
+    """
+    print_verbose("exchange(%s, %s)" % (path1, path2))
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        renameat2 = libc.renameat2
+    except (ImportError, OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    renameat2.restype = ctypes.c_int
+    if renameat2(AT_FDCWD, path1, AT_FDCWD, path2, RENAME_EXCHANGE) != 0:
+        err = ctypes.get_errno()
+        if err in [errno.ENOSYS, errno.EINVAL]:
+            return False
+        raise OSError(err, os.strerror(err), path1)
+    return True
+
 def get_profile_paths(subscribe_type):
     if subscribe_type == "user":
         login_path = os.path.expanduser("~/.login")
@@ -114,6 +185,14 @@ def groupname(gid=None):
     except:
         return str(gid)
 
+def lock(path):
+    """Acquire exclusive (advisory) lock using file at path, waiting
+    if necessary. Return object to pass to unlock().
+    """
+    f = open(path, "a")
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    return f
+
 def loads(path, alt=""):
     try:
         s = open(path, "r").read()
@@ -121,6 +200,46 @@ def loads(path, alt=""):
         s = alt
     return s
 
+def parallel_map(func, items, njobs=1):
+    """Return list of func(item) for items, calling func from up to
+    njobs threads. If func raises an exception, the first one (by
+    item order) is re-raised after all items have been processed.
+    """
+    if njobs <= 1 or len(items) <= 1:
+        return map(func, items)
+
+    results = [None]*len(items)
+    errors = []
+    q = Queue.Queue()
+    for i, item in enumerate(items):
+        q.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except:
+                errors.append((i, sys.exc_info()))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(njobs, len(items)))]
+    for t in threads:
+        t.setDaemon(True)
+        t.start()
+    for t in threads:
+        # join with timeout so that KeyboardInterrupt is delivered
+        while t.isAlive():
+            t.join(1)
+
+    if errors:
+        errors.sort()
+        _, (exc_type, exc_value, exc_tb) = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return results
+
 def print_columns(lines, headings=None, width=80, gap=2):
     """Print lines in multiple columns, with optional headings.
     """
@@ -144,8 +263,12 @@ def print_columns(lines, headings=None, width=80, gap=2):
         print "".join(chars)
 
 def print_error(s):
-    print s
-    globls.error_count += 1
+    _print_lock.acquire()
+    try:
+        print s
+        globls.error_count += 1
+    finally:
+        _print_lock.release()
     
 def print_exit(s, value=1):
     print s
@@ -153,11 +276,19 @@ def print_exit(s, value=1):
 
 def print_verbose(s):
     if globls.verbose:
-        print s
+        _print_lock.acquire()
+        try:
+            print s
+        finally:
+            _print_lock.release()
 
 def print_warning(s):
-    print s
-    globls.warning_count += 1
+    _print_lock.acquire()
+    try:
+        print s
+        globls.warning_count += 1
+    finally:
+        _print_lock.release()
 
 def prompt(msg):
     return raw_input(msg+" ")
@@ -190,6 +321,24 @@ def read_control_map(path):
     
     return m
 
+def unique(items):
+    """Return list of items without duplicates, in order of first
+    occurrence.
+    """
+    seen = set()
+    l = []
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            l.append(item)
+    return l
+
+def unlock(f):
+    """Release lock acquired by lock().
+    """
+    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    f.close()
+
 def username(uid=None):
     if uid == None:
         uid = os.getuid()
@@ -234,6 +383,69 @@ def copyfile(src, dst):
         else:
             raise
         
+def clonefile(src, dst, mode="copy"):
+    """Create dst as a hardlink to (mode "hardlink"), a reflink
+    (copy-on-write clone) of (mode "reflink") or a copy of the
+    regular file src. Falls back to a copy if a link cannot be made
+    (e.g., different filesystems, not supported). Return the mode
+    actually used.
+    """
+    if mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return mode
+        except OSError:
+            pass
+    elif mode == "reflink":
+        try:
+            sf = open(src, "rb")
+            try:
+                df = open(dst, "wb")
+                try:
+                    fcntl.ioctl(df.fileno(), FICLONE, sf.fileno())
+                finally:
+                    df.close()
+            finally:
+                sf.close()
+            shutil.copystat(src, dst)
+            return mode
+        except (IOError, OSError):
+            if os.path.lexists(dst):
+                os.remove(dst)
+    shutil.copy2(src, dst)
+    return "copy"
+
+def clonetree(src, dst, mode="copy"):
+    """Recreate the tree src at dst (which must not exist). Regular
+    files are cloned according to mode (see clonefile()), symlinks
+    are recreated and directory modes/times are copied once the tree
+    is complete.
+    """
+    print_verbose("clonetree(%s, %s, %s)" % (src, dst, mode))
+    src = os.path.normpath(src)
+    dirs = []
+    for root, dirnames, filenames in os.walk(src):
+        if root == src:
+            dst_root = dst
+        else:
+            dst_root = os.path.join(dst, root[len(src)+1:])
+        os.mkdir(dst_root, 0700)
+        dirs.append((root, dst_root))
+
+        # symlinks to dirs are listed, but not walked, as dirs
+        for name in dirnames+filenames:
+            path = os.path.join(root, name)
+            dst_path = os.path.join(dst_root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), dst_path)
+            elif os.path.isfile(path):
+                clonefile(path, dst_path, mode)
+            elif not os.path.isdir(path):
+                print_warning("warning: skipping special file (%s)" % path)
+
+    for src_dir, dst_dir in reversed(dirs):
+        shutil.copystat(src_dir, dst_dir)
+
 def copytree(src, dst):
     print_verbose("copytree(%s, %s)" % (src, dst))
     try:
@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssm_cache.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the 'cache' subcommand.
+"""
+
+# system imports
+import os
+import sys
+import time
+import traceback
+
+#
+from ssm.constants import *
+from ssm import globls
+from ssm import utils
+from ssm.cache import Cache, get_cache
+
+def print_usage():
+    print("""\
+usage: ssm cache [options]
+       ssm cache -h|--help
+
+Show statistics for, prune or clear the package download cache. The
+cache is enabled by setting $SSM_CACHE_DIR; its size limit (in MB) is
+set by $SSM_CACHE_SIZE (default is %s).
+
+Options:
+-c <path>       Path of the cache. Default is $SSM_CACHE_DIR.
+--clear         Remove all cache entries.
+--prune [<size>]
+                Evict least recently used entries until the cache
+                is no larger than <size> MB. Default is the cache
+                size limit.
+
+Miscellaneous options:
+--debug         Enable debugging.
+--verbose       Enable verbose output.""" % DEFAULT_CACHE_SIZE)
+
+def format_time(t):
+    if t == None:
+        return "-"
+    return time.strftime("%Y/%m/%dT%H:%M", time.localtime(t))
+
+if __name__ == "__main__":
+    try:
+        cache_path = None
+        operation = "stats"
+        prune_size = None
+
+        args = sys.argv[1:]
+        while args:
+            arg = args.pop(0)
+            if arg in ["-h", "--help"]:
+                print_usage()
+                sys.exit(0)
+
+            if arg in ["-c", "--cacheDir"] and args:
+                cache_path = args.pop(0)
+            elif arg in ["--clear"]:
+                operation = "clear"
+            elif arg in ["--prune"]:
+                operation = "prune"
+                if args and args[0].isdigit():
+                    prune_size = int(args.pop(0))
+
+            elif arg in ["--debug"]:
+                globls.debug = True
+            elif arg in ["--verbose"]:
+                globls.verbose = True
+            else:
+                raise Exception()
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        utils.print_exit("error: bad/missing argument(s)")
+
+    try:
+        cache = get_cache()
+        if cache_path:
+            cache = Cache(cache_path, (cache and cache.max_size) or DEFAULT_CACHE_SIZE*1024*1024)
+        if cache == None:
+            utils.print_exit("error: cache not enabled ($SSM_CACHE_DIR not set)")
+
+        if operation == "clear":
+            cache.clear()
+        elif operation == "prune":
+            if prune_size != None:
+                count = cache.prune(prune_size*1024*1024)
+            else:
+                count = cache.prune()
+            utils.print_verbose("evicted %s entries" % count)
+
+        count, size, oldest, newest = cache.stats()
+        print("Cache:          %s" % cache.path)
+        print("Entries:        %s" % count)
+        print("Size:           %.1f MB (limit %.1f MB)" % (size/1048576.0, cache.max_size/1048576.0))
+        print("Least recent:   %s" % format_time(oldest))
+        print("Most recent:    %s" % format_time(newest))
+    except SystemExit:
+        raise
+    except utils.SSMExitException, detail:
+        utils.print_exit(detail)
+    except Exception, detail:
+        if globls.debug:
+            traceback.print_exc()
+        utils.print_exit("error: operation failed")
+    sys.exit(0)
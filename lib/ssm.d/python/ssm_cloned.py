@@ -27,6 +27,7 @@
 
 # system imports
 import sys
+import time
 import traceback
 
 #
@@ -50,15 +51,29 @@ Required:
 <src>           Path of an existing domain to be cloned.
 
 Options:
+-j <int>        Number of packages to download and install
+                concurrently. Default is 1.
 -L <string>     Descriptive text for the new domain.
 -s <domain>     Alternate source for installed packages from which to
                 publish. Overrides src domain used for publishing;
                 domain must contain the package.
 -u <url>        URL of an alternate repository from which to obtain
                 packages.
+--copyInstalled <mode>
+                Clone installed packages by copying the package trees
+                from the src domain rather than downloading and
+                installing them from the repository. <mode> is one of
+                hardlink, reflink (copy-on-write), or copy; if a link
+                cannot be made, files are copied. Post-install scripts
+                are not rerun. Packages not found in the src domain
+                are installed from the repository.
 --domain        Clone domain files: support, subdomains, sources.
 --installed     Clone only installed packages.
 --published     Clone published packages.
+--republish     Republish packages already published in the new
+                domain.
+--timing        Report the time taken to install each package, and
+                to publish the packages of each platform.
 
 Miscellaneous options:
 --debug         Enable debugging.
@@ -74,9 +89,12 @@ if __name__ == "__main__":
         clone_domain = False
         clone_installed = False
         clone_published = False
+        copy_mode = None
+        njobs = 1
         repo_url = None
         republish = False
         label = DEFAULT_DOMAIN_LABEL
+        report_timing = False
 
         args = sys.argv[1:]
         while args:
@@ -85,18 +103,26 @@ if __name__ == "__main__":
                 print_usage()
                 sys.exit(0)
 
+            elif arg in ["--copyInstalled"] and args:
+                copy_mode = args.pop(0)
+                if copy_mode not in ["hardlink", "reflink", "copy"]:
+                    raise Exception()
             elif arg in ["--domain"]:
                 clone_domain = True
             elif arg in ["--installed"]:
                 clone_installed = True
             elif arg in ["--published"]:
                 clone_published = True
+            elif arg in ["-j", "--jobs"] and args:
+                njobs = int(args.pop(0))
             elif arg == "-L" and args:
                 label = args.pop(0)
-            elif arg == ["--republish"]:
+            elif arg in ["--republish"]:
                 republish = True
             elif arg == "-s" and args:
                 alt_src_domain_home = args.pop(0)
+            elif arg in ["--timing"]:
+                report_timing = True
             elif arg in ["-u"] and args:
                 repo_url = args.pop(0)
 
@@ -147,25 +173,79 @@ if __name__ == "__main__":
             utils.print_verbose("setting subdomains")
             dst_domain.set_subdomains(src_domain.get_subdomains())
 
+        # (package name, step, seconds)
+        timings = []
+
         if clone_installed:
             # populate with installed
             src_installed_map = src_domain.get_packages_with_state("installed")
-            for src_package_name, src_package in src_installed_map.items():
+            copy_package_names = []
+            if copy_mode:
+                for src_package_name, src_package in sorted(src_installed_map.items()):
+                    if src_package.domain.path == src_domain.path and src_package.exists():
+                        copy_package_names.append(src_package_name)
+            src_package_names = []
+            fetch_names = [name for name in src_installed_map.keys() if name not in copy_package_names]
+            for src_package_name, url in sorted(repo.find_many(fetch_names).items()):
+                if url == None:
+                    utils.print_warning("warning: could not find package (%s)" % src_package_name)
+                else:
+                    src_package_names.append(src_package_name)
+
+            def install_package(src_package_name):
+                """Download and extract package. Return Package object,
+                or None on failure.
+                """
                 utils.print_verbose("installing package (%s)" % src_package_name)
+                start_time = time.time()
                 tarf = repo.get(src_package_name)
                 if tarf == None:
-                    utils.print_warning("warning: could not find package (%s)" % src_package_name)
+                    utils.print_warning("warning: could not get package (%s)" % src_package_name)
+                    return None
                 dst_package = Package(dst_domain, src_package_name)
                 try:
-                    dst_package.install(tarf, None, None, False)
+                    try:
+                        dst_package.install(tarf, None, None, False, register=False)
+                    except:
+                        utils.print_warning("warning: could not install package (%s)" % src_package_name)
+                        return None
+                finally:
+                    # stops the threads reading it
+                    tarf.close()
+                timings.append((src_package_name, "install", time.time()-start_time))
+                return dst_package
+
+            def copy_package(src_package_name):
+                """Copy installed package tree from src domain. Return
+                Package object, or None on failure.
+                """
+                utils.print_verbose("copying package (%s)" % src_package_name)
+                start_time = time.time()
+                dst_package = Package(dst_domain, src_package_name)
+                try:
+                    dst_package.clone(src_installed_map[src_package_name], copy_mode, register=False)
                 except:
-                    utils.print_warning("warning: could not install package (%s)" % src_package_name)
+                    utils.print_warning("warning: could not copy package (%s)" % src_package_name)
+                    return None
+                timings.append((src_package_name, "copy", time.time()-start_time))
+                return dst_package
+
+            # copy/download/extract concurrently, update domain serially
+            dst_packages = utils.parallel_map(copy_package, copy_package_names, njobs) \
+                + utils.parallel_map(install_package, src_package_names, njobs)
+            for dst_package in dst_packages:
+                if dst_package:
+                    dst_package.register_installed()
 
         if clone_published:
-            # populate with published
+            # populate with published: determine all packages to
+            # publish, then publish them by platform (see
+            # Domain.publish_packages()), republished packages
+            # replacing themselves
+            items = {}
             for publish_platform in src_domain.get_published_platforms():
                 src_published_map = src_domain.get_packages_with_state("published", publish_platform)
-                for src_package_name, src_package in src_published_map.items():
+                for src_package_name, src_package in sorted(src_published_map.items()):
                     if alt_src_domain:
                         # publish from alt src domain
                         src_package = Package(alt_src_domain, src_package_name)
@@ -173,6 +253,7 @@ if __name__ == "__main__":
                         if not src_package.exists():
                             utils.print_warning("warning: cannot find package in alternate source domain")
                             continue
+                        dst_package = src_package
                     elif src_package.domain.path == src_domain.path:
                         # same domain
                         utils.print_verbose("publishing package (%s) from src domain (%s)" % (src_package_name, src_domain.path))
@@ -182,13 +263,27 @@ if __name__ == "__main__":
                         utils.print_verbose("publishing package (%s) from alt src domain (%s)" % (src_package_name, src_package.domain.path))
                         dst_package = src_package
 
+                    old_packages = []
                     if dst_domain.is_published(src_package_name, publish_platform):
                         if republish:
-                            dst_domain.unpublish_package(dst_package, published_platform)
+                            old_packages.append(dst_package)
                         else:
                             utils.print_warning("warning: skipping published package (%s)" % (src_package_name,))
                             continue
-                    dst_domain.publish_package(dst_package, publish_platform)
+                    items.setdefault(publish_platform, []).append((dst_package, old_packages))
+
+            for publish_platform in sorted(items):
+                start_time = time.time()
+                dst_domain.publish_packages(items[publish_platform], publish_platform)
+                timings.append(("%s package(s) (%s)" % (len(items[publish_platform]), publish_platform),
+                    "publish", time.time()-start_time))
+
+        if report_timing:
+            fmt = "%-40s %-8s %10s"
+            print(fmt % ("Package Name", "Step", "Time (s)"))
+            print(fmt % ("------------", "----", "--------"))
+            for package_name, step, seconds in timings:
+                print(fmt % (package_name, step, "%.2f" % seconds))
 
         # set frozen?
         if src_domain.is_frozen():
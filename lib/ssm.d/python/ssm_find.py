@@ -74,6 +74,26 @@ def find_in_lib(domain_home, term):
 def find_name(domain_home, term, max_depth=10):
     return __find_in_path(domain_home, term, max_depth)
 
+def find_owner(domain_home, term):
+    """Find published links matching term (relative to a platform
+    directory, e.g., bin/foo) from the publish indexes. Returns
+    "<path> (<package_name>)" items.
+    """
+    domain = Domain(domain_home)
+    term = os.path.normpath(term)
+    found = []
+    for platform in domain.get_published_platforms():
+        if not [c for c in "*?[" if c in term]:
+            # plain path: direct lookup
+            owner = domain.get_publish_owner(term, platform)
+            if owner != None:
+                found.append("%s (%s)" % (os.path.join(domain_home, platform, term), owner))
+            continue
+        index = domain.get_publish_index(platform)
+        for rel_path in fnmatch.filter(index.keys(), term):
+            found.append("%s (%s)" % (os.path.join(domain_home, platform, rel_path), index[rel_path]))
+    return sorted(found)
+
 def match_domains(domain_homes, term):
     found_map = {}
     for domain_home in domain_homes:
@@ -136,6 +156,8 @@ Options:
                 domain - match domain name
                 lib - match file under domain lib/ directory
                 name - match filename/dirname
+                owner - match published file (e.g., bin/foo) and
+                show the package owning it
                 package - match package name; this is default
 
 Miscellaneous options:
@@ -220,7 +242,7 @@ if __name__ == "__main__":
                     paths = []
 
                     # get package_names or paths; force output_type if necessary
-                    if find_type in ["bin", "domain", "lib", "name"]:
+                    if find_type in ["bin", "domain", "lib", "name", "owner"]:
                         output_type = "long"
                         if find_type == "bin":
                             paths = find_in_bin(domain_home, term)
@@ -230,6 +252,8 @@ if __name__ == "__main__":
                             paths = find_in_lib(domain_home, term)
                         elif find_type == "name":
                             paths = find_name(domain_home, term, depth)
+                        elif find_type == "owner":
+                            paths = find_owner(domain_home, term)
                     elif find_type == "package":
                         package_names = domain.get_package_names(term)
                         if output_type == "long":
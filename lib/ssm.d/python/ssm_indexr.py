@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssm_indexr.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the 'indexr' subcommand.
+"""
+
+# system imports
+import sys
+import traceback
+
+#
+from ssm import globls
+from ssm import utils
+from ssm.domain import Domain
+from ssm.repository import Repository, INDEX_NAME
+
+def print_usage():
+    print("""\
+usage: ssm indexr [options]
+       ssm indexr -h|--help
+
+Generate/refresh the package index (%s) of a filesystem
+repository. When present, the index is used instead of a directory
+listing to find packages; it must be refreshed whenever packages are
+added to or removed from the repository.
+
+Options:
+-d <path>       Path of the domain from which to get repository
+                information. Default is $SSM_DOMAIN_HOME.
+-u <url>        URL of repository to index.
+
+Miscellaneous options:
+--debug         Enable debugging.
+--verbose       Enable verbose output.""" % INDEX_NAME)
+
+if __name__ == "__main__":
+    try:
+        domain_home = None
+        repo_url = None
+
+        args = sys.argv[1:]
+        while args:
+            arg = args.pop(0)
+            if arg in ["-h", "--help"]:
+                print_usage()
+                sys.exit(0)
+
+            if arg in ["-d", "--domainHome"] and args:
+                domain_home = args.pop(0)
+            elif arg in ["-u", "--repositoryUrl"] and args:
+                repo_url = args.pop(0)
+
+            elif arg in ["--debug"]:
+                globls.debug = True
+            elif arg in ["--verbose"]:
+                globls.verbose = True
+            else:
+                raise Exception()
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        utils.print_exit("error: bad/missing argument(s)")
+
+    try:
+        if repo_url:
+            sources = [repo_url]
+        else:
+            domain = Domain(domain_home)
+            sources = domain.get_sources().split("\n")
+
+        for source in sources:
+            source = source.strip()
+            if source == "":
+                continue
+            repo = Repository(source)
+            if not repo.is_local():
+                utils.print_warning("warning: skipping non-filesystem repository (%s)" % source)
+                continue
+            count = repo.build_index()
+            utils.print_verbose("indexed %s packages for repository (%s)" % (count, source))
+    except SystemExit:
+        raise
+    except utils.SSMExitException, detail:
+        utils.print_exit(detail)
+    except Exception, detail:
+        if globls.debug:
+            traceback.print_exc()
+        utils.print_exit("error: operation failed")
+    sys.exit(0)
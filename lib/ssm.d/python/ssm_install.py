@@ -44,11 +44,17 @@ def print_usage():
 usage: ssm install [options] [required]
        ssm install -h|--help
 
-Install a package to a domain.
+Install one or more packages to a domain. All packages are found in
+the repositories before any is installed. With -j, packages are
+downloaded and extracted concurrently; the domain is updated once
+all have been extracted.
 
 Required (either):
 -f <filename>   Package filename (ending with .ssm).
--p <name>       Name of a packages to install.
+-p <name>[,...] Comma-separated list of names of packages to install.
+--from-file <path>
+                File listing names of packages to install, one per
+                line.
 
 Options:
 -d <path>       Path of the domain in which to install the package.
@@ -58,8 +64,23 @@ Options:
                 sources.list settings.
 --clobber       Permit any exiting files to be overwritten. Default
                 is a non-destructive overlay.
+-j <int>        Number of packages to install concurrently. Default
+                is 1.
+--extractJobs <int>
+                Number of files of a package to write concurrently,
+                for uncompressed packages available as files (not
+                with --stream). Default is 1.
+--mmap          Read uncompressed packages through a memory mapping of
+                the package file (local repository or cache) rather
+                than through file buffers.
+--noChecksums   Do not record the md5 of each file in the package
+                manifest, so that the files of uncompressed packages
+                may be copied in the kernel.
 --skipOnInstalled
                 Skip if the package has already been installed.
+--stream        Extract the package while it is being read from the
+                repository, without first downloading it to a
+                temporary file.
 
 Miscellaneous options:
 --debug         Enable debugging.
@@ -69,13 +90,18 @@ Miscellaneous options:
 
 if __name__ == "__main__":
     try:
+        checksums = True
         clobber = False
         domain_home = None
+        extract_jobs = 1
         filename = None
         groupname = utils.groupname()
-        package_name = None
+        njobs = 1
+        use_mmap = False
+        package_names = []
         skip_on_installed = False
         sources = None
+        stream = False
         username = utils.username()
 
         args = sys.argv[1:]
@@ -89,14 +115,29 @@ if __name__ == "__main__":
                 clobber = True
             elif arg in ["-d", "--domainHome"] and args:
                 domain_home = args.pop(0)
+            elif arg in ["--extractJobs"] and args:
+                extract_jobs = int(args.pop(0))
             elif arg in ["-f"] and args:
                 filename = args.pop(0)
+            elif arg in ["--from-file"] and args:
+                for line in open(args.pop(0)).read().split("\n"):
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        package_names.append(line)
             elif arg in ["-G", "--groupName"] and args:
                 groupname = args.pop(0)
+            elif arg in ["-j", "--jobs"] and args:
+                njobs = int(args.pop(0))
+            elif arg in ["--mmap"]:
+                use_mmap = True
             elif arg in ["-p", "--packageName"] and args:
-                package_name = args.pop(0)
+                package_names.extend([name for name in args.pop(0).split(",") if name])
+            elif arg in ["--noChecksums"]:
+                checksums = False
             elif arg in ["--skipOnInstalled"]:
                 skip_on_installed = True
+            elif arg in ["--stream"]:
+                stream = True
             elif arg in ["-u", "--repositoryUrl"] and args:
                 sources = args.pop(0).split(",")
             elif arg in ["-U", "--userName"] and args:
@@ -122,35 +163,71 @@ if __name__ == "__main__":
     if filename:
         if filename.endswith(".ssm"):
             sources = [os.path.realpath(os.path.dirname(filename))]
-            package_name = os.path.basename(filename)[:-4]
+            package_names = [os.path.basename(filename)[:-4]]
         else:
             utils.print_exit("error: bad filename")
-    if not package_name:
+    if not package_names:
         utils.print_exit("error: missing package name")
+    # e.g., -p a,a
+    package_names = utils.unique(package_names)
 
     try:
         domain = Domain(domain_home)
         if not domain.is_compatible():
             utils.print_exit(MSG_INCOMPATIBLE_DOMAIN)
 
-        if domain.is_installed(package_name) and skip_on_installed:
-            utils.print_verbose("skipping installed package")
-        else:
-            if sources == None:
-                sources = domain.get_sources().split("\n")
-            for source in sources:
-                source = source.strip()
-                if source == "":
-                    continue
-                repo = Repository(source)
-                tarf = repo.get(package_name)
-                if tarf != None:
-                    utils.print_verbose("installing package (%s) from repository (%s)" % (package_name, source))
-                    pkg = Package(domain, package_name)
-                    pkg.install(tarf, username, groupname, clobber)
-                    break
+        if skip_on_installed:
+            for package_name in package_names[:]:
+                if domain.is_installed(package_name):
+                    utils.print_verbose("skipping installed package (%s)" % package_name)
+                    package_names.remove(package_name)
+
+        if sources == None:
+            sources = domain.get_sources().split("\n")
+        repos = [Repository(source.strip()) for source in sources if source.strip() != ""]
+
+        # find all packages before installing any
+        package_repos = {}
+        missing_names = []
+        for package_name in package_names:
+            package_repos[package_name] = [repo for repo in repos if repo.find(package_name)]
+            if not package_repos[package_name]:
+                missing_names.append(package_name)
+        if missing_names:
+            utils.print_exit("error: could not find package (%s)" % ", ".join(missing_names))
+
+        def install_package(package_name):
+            """Download and extract package. Return Package object, or
+            None on failure.
+            """
+            try:
+                for repo in package_repos[package_name]:
+                    tarf = repo.get(package_name, stream, use_mmap)
+                    if tarf != None:
+                        utils.print_verbose("installing package (%s) from repository (%s)" % (package_name, repo.source))
+                        pkg = Package(domain, package_name)
+                        try:
+                            pkg.install(tarf, username, groupname, clobber, register=False, jobs=extract_jobs, checksums=checksums)
+                        finally:
+                            # stops the threads reading it
+                            tarf.close()
+                        return pkg
+                raise utils.SSMExitException("error: could not get package")
+            except utils.SSMExitException, detail:
+                utils.print_error("%s (%s)" % (detail, package_name))
+            return None
+
+        packages = utils.parallel_map(install_package, package_names, njobs)
+
+        # update domain serially
+        failed_count = 0
+        for pkg in packages:
+            if pkg == None:
+                failed_count += 1
             else:
-                utils.print_exit("error: could not find package")
+                pkg.register_installed()
+        if failed_count:
+            utils.print_exit("error: could not install %s package(s)" % failed_count)
     except SystemExit:
         raise
     except utils.SSMExitException, detail:
@@ -0,0 +1,145 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ssm_pack.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Provides the 'pack' subcommand.
+"""
+
+# system imports
+import os.path
+import sys
+import traceback
+
+#
+from ssm import globls
+from ssm import utils
+from ssm.pack import pack_package, COMPRESSIONS
+from ssm.repository import update_index, INDEX_NAME
+
+def print_usage():
+    print("""\
+usage: ssm pack [options] <path> [...]
+       ssm pack -h|--help
+
+Create a package file (<name>.ssm) from each package directory
+<path> (named <name>). Members are stored in sorted order with
+owner and group set to 0, so that the same directory always gives
+the same package. For each package, the fields of its repository
+index entry (see 'ssm indexr') and its number of members are
+printed, tab-separated:
+
+<package_name> <filename> <size> <mtime> <md5> <member_count>
+
+Options:
+-c <type>       Compression type: gz, xz, zst, or tar (none). Default
+                is gz.
+-j <int>        Number of threads compressing each package (gz and
+                zst). gz packages are then written as independent
+                blocks, which are also decompressed concurrently when
+                installing. Default is 1.
+-l <int>        Compression level. Default is 6 for gz and xz, 3 for
+                zst.
+-o <path>       Output directory, or output file if packing a single
+                package. Default is the current directory.
+--index         Add the packages to the index (%s) of the output
+                directory.
+
+Miscellaneous options:
+--debug         Enable debugging.
+--verbose       Enable verbose output.""" % INDEX_NAME)
+
+if __name__ == "__main__":
+    try:
+        comptype = "gz"
+        compresslevel = None
+        njobs = 1
+        out_path = "."
+        paths = []
+        update = False
+
+        args = sys.argv[1:]
+        while args:
+            arg = args.pop(0)
+            if arg in ["-h", "--help"]:
+                print_usage()
+                sys.exit(0)
+
+            if arg in ["-c", "--compression"] and args:
+                comptype = args.pop(0)
+                if comptype not in COMPRESSIONS:
+                    raise Exception()
+            elif arg in ["--index"]:
+                update = True
+            elif arg in ["-j", "--jobs"] and args:
+                njobs = int(args.pop(0))
+            elif arg in ["-l", "--level"] and args:
+                compresslevel = int(args.pop(0))
+            elif arg in ["-o", "--output"] and args:
+                out_path = args.pop(0)
+
+            elif arg in ["--debug"]:
+                globls.debug = True
+            elif arg in ["--verbose"]:
+                globls.verbose = True
+            elif not arg.startswith("-"):
+                paths.append(arg)
+            else:
+                raise Exception()
+    except SystemExit:
+        raise
+    except:
+        if globls.debug:
+            traceback.print_exc()
+        utils.print_exit("error: bad/missing argument(s)")
+
+    if not paths:
+        utils.print_exit("error: missing package directory")
+    if not os.path.isdir(out_path) and len(paths) > 1:
+        utils.print_exit("error: output must be a directory for several packages")
+
+    try:
+        entries = {}
+        for path in paths:
+            if os.path.isdir(out_path):
+                package_name = os.path.basename(os.path.normpath(path))
+                package_path = os.path.join(out_path, package_name+".ssm")
+            else:
+                package_path = out_path
+            utils.print_verbose("packing (%s) into (%s)" % (path, package_path))
+            entry = pack_package(path, package_path, comptype, compresslevel, njobs)
+            print "\t".join(map(str, entry))
+            entries.setdefault(os.path.dirname(os.path.abspath(package_path)), []).append(entry[:5])
+
+        if update:
+            for base_path, base_entries in entries.items():
+                utils.print_verbose("updating index (%s)" % os.path.join(base_path, INDEX_NAME))
+                update_index(base_path, base_entries)
+    except SystemExit:
+        raise
+    except utils.SSMExitException, detail:
+        utils.print_exit(detail)
+    except Exception, detail:
+        if globls.debug:
+            traceback.print_exc()
+        utils.print_exit("error: operation failed")
+    sys.exit(0)
@@ -44,13 +44,34 @@ def print_usage():
 usage: ssm publish [options] [required]
        ssm publish -h|--help
 
-Publish a package to a domain. To publish a package from one domain
-to an alternate domain, use the -P option.
-
-Required:
--p <name>       Name of a package to publish.
+Publish one or more packages to a domain. To publish a package from
+one domain to an alternate domain, use the -P option. The published
+state of the domain is read once, and the files of all packages are
+checked, against each other and those already published, before any
+package is published.
+
+Required (either):
+-p <name>[,...] Comma-separated list of names of packages to publish.
+--from-file <path>
+                File listing names of packages to publish, one per
+                line.
 
 Options:
+--atomic        Publish in a copy of the platform directory which
+                then replaces it in a single rename, so that the
+                packages (and the unpublishing of the packages they
+                replace) appear at once and a failure leaves the
+                platform directory unchanged. The replaced directory
+                is kept (as <domain>/.<platform>.publishing) for the
+                next --atomic publish to update at the cost of what
+                changed; the first one, or one after a publish
+                without --atomic, copies the whole platform directory.
+                Packages with publish/unpublish scripts are refused:
+                the scripts would change the platform directory, not
+                the copy. Atomicity is per platform: with packages
+                for several platforms, each platform directory is
+                replaced in turn, and a failure leaves those already
+                replaced as published.
 -d <path>       Path of the domain of the installed package. Also
                 serves as the default domain in which to publish the
                 package. Default is $SSM_DOMAIN_HOME.
@@ -67,8 +88,9 @@ Miscellaneous options:
 
 if __name__ == "__main__":
     try:
+        atomic = False
         domain_home = None
-        package_name = None
+        package_names = []
         publish_home = None
         publish_platform = None
         #force_publish = False
@@ -81,10 +103,17 @@ if __name__ == "__main__":
                 print_usage()
                 sys.exit(0)
 
+            elif arg in ["--atomic"]:
+                atomic = True
             elif arg in ["-d", "--domainHome"] and args:
                 domain_home = args.pop(0)
+            elif arg in ["--from-file"] and args:
+                for line in open(args.pop(0)).read().split("\n"):
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        package_names.append(line)
             elif arg in ["-p", "--packageName"] and args:
-                package_name = args.pop(0)
+                package_names.extend([name for name in args.pop(0).split(",") if name])
             elif arg in ["-pp"] and args:
                 publish_platform = args.pop(0)
             elif arg in ["-P", "--publishHome"] and args:
@@ -109,8 +138,10 @@ if __name__ == "__main__":
             traceback.print_exc()
         utils.print_exit("error: bad/missing argument(s)")
 
-    if not package_name:
+    if not package_names:
         utils.print_exit("error: missing package name")
+    # e.g., -p a,a
+    package_names = utils.unique(package_names)
 
     try:
         domain = Domain(domain_home)
@@ -123,30 +154,67 @@ if __name__ == "__main__":
         publish_domain = Domain(publish_home)
         if not publish_domain.is_domain():
             utils.print_exit("error: cannot find domain (%s)" % publish_domain)
-        package = Package(domain, package_name)
-        publish_platform = publish_platform or package.platform
-
-        # check for package
-        if not package.domain.is_installed(package_name):
-            utils.print_exit("error: cannot find package (%s)" % package_name)
-
-        # unpublish named package if necessary
-        if publish_domain.is_published(package_name, publish_platform):
-            if skip_on_published:
-                utils.print_exit("skipping published package", 0)
-            if not globls.force and not globls.auto_yes:
-                if utils.prompt("unpublish current package (y/n)?").lower() not in ["y"]:
-                    utils.print_exit("operation aborted")
-            publish_domain.unpublish_package(package, publish_platform)
-
-        # unpublish "similar" package
-        for pp_path in publish_domain.get_published(publish_platform):
-            pp_name = os.path.basename(pp_path)
-            if package.is_similar(pp_name):
-                publish_domain.unpublish_package(Package(domain, pp_name), publish_platform)
-
-        # ready to publish
-        publish_domain.publish_package(package, publish_platform)
+        packages = [Package(domain, package_name) for package_name in package_names]
+
+        # check for packages
+        missing_names = [package.name for package in packages if not domain.is_installed(package.name)]
+        if missing_names:
+            utils.print_exit("error: cannot find package (%s)" % ", ".join(missing_names))
+
+        # by platform, packages with those they replace: the named
+        # package if published, and "similar" packages
+        items = {}
+        published_names = {}
+        current_names = []
+        for package in packages:
+            platform = publish_platform or package.platform
+            if platform not in published_names:
+                published_names[platform] = [os.path.basename(path) for path in publish_domain.get_published(platform)]
+            for other_package, _ in items.get(platform, []):
+                if package.is_similar(other_package.name):
+                    utils.print_exit("error: cannot publish similar packages (%s, %s)" % (other_package.name, package.name))
+
+            old_packages = []
+            is_current = publish_domain.is_published(package.name, platform)
+            if is_current:
+                if skip_on_published:
+                    utils.print_verbose("skipping published package (%s)" % package.name)
+                    continue
+                current_names.append(package.name)
+                old_packages.append(package)
+            for pp_name in published_names[platform]:
+                if package.is_similar(pp_name) and not (is_current and pp_name == package.name):
+                    old_packages.append(Package(domain, pp_name))
+            items.setdefault(platform, []).append((package, old_packages))
+
+        if not items:
+            utils.print_exit("skipping published package", 0)
+        if current_names and not globls.force and not globls.auto_yes:
+            if utils.prompt("unpublish current package (y/n)?").lower() not in ["y"]:
+                utils.print_exit("operation aborted")
+
+        # ready to publish; only links which differ are changed
+        started = []
+        try:
+            for platform in sorted(items):
+                if atomic:
+                    publish_domain.start_publish(platform)
+                    started.append(platform)
+                publish_domain.publish_packages(items[platform], platform)
+        except:
+            for platform in started:
+                publish_domain.abort_publish(platform)
+            raise
+        # platforms are committed in turn: those committed stay so if
+        # a later commit fails
+        while started:
+            platform = started.pop(0)
+            try:
+                publish_domain.commit_publish(platform)
+            except:
+                for platform in started:
+                    publish_domain.abort_publish(platform)
+                raise
     except SystemExit:
         raise
     except utils.SSMExitException, detail:
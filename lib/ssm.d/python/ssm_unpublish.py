@@ -44,16 +44,20 @@ def print_usage():
 usage: ssm unpublish [options] [required]
        ssm unpublish -h|--help
 
-Unpublish a package from a domain.
+Unpublish one or more packages from a domain.
 
-Required:
--p <name>       Name of a package to publish.
--pp <platform>  Platform from which to unpublish package. Default is
-                the package platform.
+Required (either):
+-p <name>[,...] Comma-separated list of names of packages to
+                unpublish.
+--from-file <path>
+                File listing names of packages to unpublish, one per
+                line.
 
 Options:
--d <path>       Path of the domain of the published package. Default
-                is $SSM_DOMAIN_HOME.
+-d <path>       Path of the domain of the published packages.
+                Default is $SSM_DOMAIN_HOME.
+-pp <platform>  Platform from which to unpublish packages. Default is
+                the package platform.
 
 Miscellaneous options:
 --debug         Enable debugging.
@@ -64,7 +68,7 @@ Miscellaneous options:
 if __name__ == "__main__":
     try:
         domain_home = None
-        package_name = None
+        package_names = []
         publish_platform = None
 
         args = sys.argv[1:]
@@ -76,8 +80,13 @@ if __name__ == "__main__":
 
             elif arg in ["-d", "--domainHome"] and args:
                 domain_home = args.pop(0)
+            elif arg in ["--from-file"] and args:
+                for line in open(args.pop(0)).read().split("\n"):
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        package_names.append(line)
             elif arg in ["-p", "--packageName"] and args:
-                package_name = args.pop(0)
+                package_names.extend([name for name in args.pop(0).split(",") if name])
             elif arg in ["-pp"] and args:
                 publish_platform = args.pop(0)
 
@@ -98,19 +107,31 @@ if __name__ == "__main__":
             traceback.print_exc()
         utils.print_exit("error: bad/missing argument(s)")
 
-    if not package_name:
+    if not package_names:
         utils.print_exit("error: missing package name")
+    # e.g., -p a,a
+    package_names = utils.unique(package_names)
 
     try:
         domain = Domain(domain_home)
         if not domain.is_compatible():
             utils.print_exit(MSG_INCOMPATIBLE_DOMAIN)
-        package = Package(domain, package_name)
-        if publish_platform == None:
-            _, _, publish_platform = package.name.split("_", 2)
-        if not domain.is_published(package_name, publish_platform) and not globls.force:
-            utils.print_exit("error: package not published")
-        domain.unpublish_package(package, publish_platform)
+        # by platform
+        packages = {}
+        unpublished_names = []
+        for package_name in package_names:
+            package = Package(domain, package_name)
+            platform = publish_platform
+            if platform == None:
+                _, _, platform = package.name.split("_", 2)
+            if not domain.is_published(package_name, platform) and not globls.force:
+                unpublished_names.append(package_name)
+            packages.setdefault(platform, []).append(package)
+        if unpublished_names:
+            utils.print_exit("error: package not published (%s)" % ", ".join(unpublished_names))
+
+        for platform in sorted(packages):
+            domain.unpublish_packages(packages[platform], platform)
     except SystemExit:
         raise
     except utils.SSMExitException, detail:
@@ -39,6 +39,9 @@ Package management:
 Domain management:
     ssm created|freezed|showd|unfreezed|updated [<args>]
 
+Repository management:
+    ssm cache|indexr|pack [<args>]
+
 System/user profile management:
     ssm subscribe|unsubscribe [<args>]
 
@@ -77,6 +80,8 @@ case ${subcommand} in
 	print_usage
 	exit 0
 	;;
+cache)
+	exec ${LIB_DIR}/python/ssm_cache.py "$@" ;;
 cloned)
 	exec ${LIB_DIR}/python/ssm_cloned.py "$@" ;;
 created)
@@ -87,6 +92,8 @@ find)
 	exec ${LIB_DIR}/python/ssm_find.py "$@" ;;
 freezed)
 	exec ${LIB_DIR}/python/ssm_freezed.py "$@" ;;
+indexr)
+	exec ${LIB_DIR}/python/ssm_indexr.py "$@" ;;
 install)
 	exec ${LIB_DIR}/python/ssm_install.py "$@" ;;
 listd)
@@ -95,6 +102,8 @@ listdh)
 	exec ${LIB_DIR}/python/ssm_listdh.py "$@" ;;
 listr)
 	exec ${LIB_DIR}/python/ssm_listr.py "$@" ;;
+pack)
+	exec ${LIB_DIR}/python/ssm_pack.py "$@" ;;
 platforms)
 	ssmuse_platforms ;;
 publish)
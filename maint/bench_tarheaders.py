@@ -0,0 +1,112 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# bench_tarheaders.py
+
+# GPL--start
+# This file is part of ssm (Simple Software Manager)
+# Copyright (C) 2005-2012 Environment/Environnement Canada
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; version 2
+# of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+# GPL--end
+
+"""Micro-benchmark of tar header parsing in ssm.ext_tarfile.
+
+A synthetic archive of empty members (default 100000) is built in
+memory, then the headers are decoded with TarInfo.frombuf() and by
+iterating over a TarFile. Run it against two trees to compare:
+
+    python maint/bench_tarheaders.py [-n <count>] [-r <repeat>] [<pythonpath>]
+"""
+
+# system imports
+import os.path
+import sys
+import time
+from StringIO import StringIO
+
+def build_archive(tarfile, count):
+    """Return the contents of an uncompressed archive of count
+    members (directories, regular files and symlinks).
+    """
+    f = StringIO()
+    tarf = tarfile.open(fileobj=f, mode="w", format=tarfile.USTAR_FORMAT)
+    for i in xrange(count):
+        tarinfo = tarfile.TarInfo("pkg_1.0_all/lib/dir%d/file%d.so" % (i % 100, i))
+        tarinfo.uname = "builder"
+        tarinfo.gname = "users"
+        tarinfo.mtime = 1300000000+i
+        if i % 10 == 0:
+            tarinfo.type = tarfile.DIRTYPE
+            tarinfo.mode = 0755
+        elif i % 10 == 1:
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = "file%d.so" % (i-1,)
+        tarf.addfile(tarinfo)
+    tarf.close()
+    return f.getvalue()
+
+def bench(func, repeat):
+    """Return best time of repeat calls to func.
+    """
+    best = None
+    for i in xrange(repeat):
+        start_time = time.time()
+        func()
+        t = time.time()-start_time
+        if best == None or t < best:
+            best = t
+    return best
+
+if __name__ == "__main__":
+    count = 100000
+    repeat = 3
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib", "ssm.d", "python")
+
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg in ["-h", "--help"]:
+            print __doc__
+            sys.exit(0)
+        elif arg == "-n" and args:
+            count = int(args.pop(0))
+        elif arg == "-r" and args:
+            repeat = int(args.pop(0))
+        elif not args:
+            path = arg
+        else:
+            sys.stderr.write("error: bad argument (%s)\n" % arg)
+            sys.exit(1)
+
+    sys.path.insert(0, path)
+    from ssm import ext_tarfile as tarfile
+
+    s = build_archive(tarfile, count)
+    bufs = [s[i:i+tarfile.BLOCKSIZE] for i in xrange(0, count*tarfile.BLOCKSIZE, tarfile.BLOCKSIZE)]
+
+    def run_frombuf():
+        frombuf = tarfile.TarInfo.frombuf
+        for buf in bufs:
+            frombuf(buf)
+
+    def run_iterate():
+        for tarinfo in tarfile.open(fileobj=StringIO(s), mode="r:"):
+            pass
+
+    print "members: %d (%s)" % (count, tarfile.__file__)
+    for name, func in [("frombuf", run_frombuf), ("iterate", run_iterate)]:
+        t = bench(func, repeat)
+        print "%-10s %8.3f s %12.0f headers/s" % (name, t, count/t)